@@ -1,53 +1,86 @@
 import os
 import sys
 sys.path.append( os.path.dirname(os.path.abspath(__file__)))
-import wcocr
 import fitz
-import threading
-def _find_wechat_path():
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    common_paths = os.path.join(script_dir, 'path')
-    if os.path.exists(common_paths):
-        return common_paths
-    else:
-        print(f"The path folder does not exist at {common_paths}.")
-        return None
-
-def _find_wechatocr_exe():
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    wechatocr_path = os.path.join(script_dir, 'path', 'WeChatOCR', 'WeChatOCR.exe')
-    if os.path.isfile(wechatocr_path):
-        return wechatocr_path
-    else:
-        print(f"The WeChatOCR.exe does not exist at {wechatocr_path}.")
-        return None
-_wechat_path = _find_wechat_path()
-_wechatocr_path = _find_wechatocr_exe()
-if _wechat_path and _wechatocr_path:
-    wcocr.init(_wechatocr_path, _wechat_path)
+from contextlib import nullcontext
+from .backend import OcrLine, OcrBackend, WeChatOcrBackend, TextLayerStubBackend
+
+# 可用的ocr后端，名字:类
+backends = {
+    WeChatOcrBackend.name: WeChatOcrBackend,
+    TextLayerStubBackend.name: TextLayerStubBackend,
+}
+backend_name = os.environ.get("FA_PIAO_OCR_BACKEND", WeChatOcrBackend.name)  # 默认用微信ocr，可以用环境变量或set_backend修改
+_backend = None
+stage_timer = None  # 统计耗时的钩子，stage_timer("render")返回一个上下文管理器，见metrics.stage。为None时不统计
+
+def _stage(name):
+    return stage_timer(name) if stage_timer is not None else nullcontext()
+
+def set_backend(name):
+    """
+    选择ocr后端。只记录名字，后端在第一次ocr时才创建
+    """
+    global backend_name, _backend
+    if name not in backends:
+        raise ValueError(f"unknown ocr backend {name}, available: {list(backends)}")
+    if name != backend_name:
+        _backend = None
+    backend_name = name
+
+def get_backend() -> OcrBackend:
+    """
+    返回当前进程的ocr后端，第一次调用时才创建(初始化ocr引擎)，之后一直复用
+    """
+    global _backend
+    if _backend is None:
+        _backend = backends[backend_name]()
+    return _backend
+
 def wechat_ocr(image_path):
-    result = wcocr.ocr(image_path)
-    texts = []
-
-    for temp in result['ocr_response']:
-        text = temp['text']
-        if isinstance(text, bytes):
-            text = text.decode('utf-8', errors='ignore')
-        texts.append(text)
-
-    return texts
-
-def ocr_pdf(pdf_path):
-    doc = fitz.open(pdf_path)
-    page_texts = []
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)  # 加载页面
-        # 提高图像清晰度，设置分辨率为300dpi
-        pix = page.get_pixmap(matrix=fitz.Matrix(300 / 72, 300 / 72),colorspace=fitz.csGRAY)  # 获取页面的像素映射
-        image_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),f"picture_thread_{threading.current_thread().ident}.png")
-        pix.save(image_path)
-        texts = wechat_ocr(image_path)
-        page_texts.append(texts)
-        os.remove(image_path)
-    doc.close()
-    return page_texts
\ No newline at end of file
+    backend = get_backend()
+    if not isinstance(backend, WeChatOcrBackend):
+        raise RuntimeError(f"wechat_ocr needs the {WeChatOcrBackend.name} backend, current backend is {backend.name}")
+    return [item['text'] for item in backend.ocr_image_path(image_path)]
+
+def ocr_pdf_page_lines(pdf, page_numbers=(-1,), dpi=300, colorspace=fitz.csGRAY, clip=None):
+    """
+    只渲染并ocr指定的页(page_numbers, 支持负数下标，默认只有最后一页)，返回每一页识别出的行(OcrLine，带坐标)，顺序与page_numbers一致。
+    所有页渲染完后一次交给后端识别(backend.ocr_pixmaps，微信ocr会把多页拼成一张图，只调用一次)
+    dpi、colorspace是渲染参数；clip是fitz.Rect，不为None时只渲染页面中的这个区域
+    pdf可以是pdf路径，也可以是已经打开的fitz.Document(此时不会重复打开，也不会关闭它)
+    """
+    own_doc = not isinstance(pdf, fitz.Document)
+    doc = fitz.open(pdf) if own_doc else pdf
+    with _stage("ocr_init"):
+        backend = get_backend()
+    pages = [doc[page_num] for page_num in page_numbers]  # 加载页面
+    pixmaps = []
+    for page in pages:
+        # 提高图像清晰度，默认分辨率为300dpi
+        with _stage("render"):
+            pixmaps.append(page.get_pixmap(matrix=fitz.Matrix(dpi / 72, dpi / 72),colorspace=colorspace,clip=clip))  # 获取页面的像素映射
+    with _stage("ocr"):
+        page_lines = backend.ocr_pixmaps(pixmaps, pages, dpi, clip)
+    if own_doc:
+        doc.close()
+    return page_lines
+
+def ocr_pdf_pages(pdf, page_numbers=(-1,), dpi=300, colorspace=fitz.csGRAY, clip=None):
+    """
+    和ocr_pdf_page_lines一样，但每一页只返回ocr文本列表
+    """
+    page_lines = ocr_pdf_page_lines(pdf, page_numbers, dpi, colorspace, clip)
+    return [[line.text for line in lines] for lines in page_lines]
+
+def ocr_pdf(pdf):
+    """
+    ocr所有页。pdf可以是pdf路径，也可以是已经打开的fitz.Document(此时不会重复打开，也不会关闭它)
+    只需要某几页时请用ocr_pdf_pages
+    """
+    own_doc = not isinstance(pdf, fitz.Document)
+    doc = fitz.open(pdf) if own_doc else pdf
+    page_texts = ocr_pdf_pages(doc, range(len(doc)))
+    if own_doc:
+        doc.close()
+    return page_texts
@@ -0,0 +1,170 @@
+import os
+import tempfile
+from bisect import bisect_right
+from collections import namedtuple
+from typing import List
+import fitz
+
+# ocr识别出的一行文本，(x0,y0)是左上角坐标，(x1,y1)是右下角坐标，坐标已经换算成pdf页面坐标(和page.get_text("blocks")的坐标一致)
+OcrLine = namedtuple("OcrLine", ["text", "x0", "y0", "x1", "y1"])
+
+
+class OcrBackend(object):
+    """
+    ocr后端的接口。
+    ocr_pixmap 输入渲染好的页面图片，返回识别出的行(OcrLine)。
+    pix是page(或page中的clip区域)按dpi渲染出的图片，page、dpi、clip用来把图片的像素坐标换算成页面坐标。
+    ocr_pixmaps 一次识别多页，返回每一页的行。默认逐页调用ocr_pixmap，后端可以改成一次调用识别所有页
+    后端对象在第一次使用时创建(见OCR.get_backend)，之后在同一个进程中一直复用。
+    """
+    name = ""
+
+    def ocr_pixmap(self, pix, page, dpi=300, clip=None) -> List[OcrLine]:
+        raise NotImplementedError
+
+    def ocr_pixmaps(self, pixmaps, pages, dpi=300, clip=None) -> List[List[OcrLine]]:
+        return [self.ocr_pixmap(pix, page, dpi, clip) for pix, page in zip(pixmaps, pages)]
+
+
+def _find_wechat_path():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    common_paths = os.path.join(script_dir, 'path')
+    if os.path.exists(common_paths):
+        return common_paths
+    else:
+        print(f"The path folder does not exist at {common_paths}.")
+        return None
+
+def _find_wechatocr_exe():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    wechatocr_path = os.path.join(script_dir, 'path', 'WeChatOCR', 'WeChatOCR.exe')
+    if os.path.isfile(wechatocr_path):
+        return wechatocr_path
+    else:
+        print(f"The WeChatOCR.exe does not exist at {wechatocr_path}.")
+        return None
+
+def _find_tmp_dir():
+    """
+    渲染出来的图片放在哪里：优先用内存文件系统/dev/shm，没有的话用系统临时目录，不再写到安装目录里
+    """
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+class WeChatOcrBackend(OcrBackend):
+    """
+    微信ocr(wcocr + WeChatOCR.exe)。创建对象时才import wcocr并初始化，不需要ocr时不会付出初始化的开销
+    """
+    name = "wechat"
+    stitch_gap = 40  # 多页拼成一张图时，页之间空白的像素数，避免两页的文字被识别成一行
+    stitch_max_height = 8000  # 拼成的图最高多少像素，太高时微信ocr会缩小图片，识别率下降，超过时分成几张图
+
+    def __init__(self):
+        import wcocr
+        self.wcocr = wcocr
+        wechat_path = _find_wechat_path()
+        wechatocr_path = _find_wechatocr_exe()
+        if wechat_path and wechatocr_path:
+            wcocr.init(wechatocr_path, wechat_path)
+        self.tmp_dir = _find_tmp_dir()
+
+    def ocr_image_path(self, image_path) -> List[dict]:
+        """
+        返回wcocr的原始结果ocr_response，text已经解码成str
+        """
+        result = self.wcocr.ocr(image_path)
+        items = []
+        for temp in result['ocr_response']:
+            text = temp['text']
+            if isinstance(text, bytes):
+                text = text.decode('utf-8', errors='ignore')
+            item = dict(temp)
+            item['text'] = text
+            items.append(item)
+        return items
+
+    def _ocr_png(self, pix) -> List[dict]:
+        """
+        wcocr.ocr只接受图片路径，不接受内存中的图片，所以这里把png字节写到临时目录(self.tmp_dir)中的临时文件，ocr后马上删除
+        """
+        fd, image_path = tempfile.mkstemp(suffix=".png", prefix="fa_piao_ocr_", dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(pix.tobytes("png"))
+            return self.ocr_image_path(image_path)
+        finally:
+            os.remove(image_path)
+
+    def _to_line(self, item, dpi, clip, top=0):
+        """
+        wcocr结果中的一行换算成页面坐标的OcrLine，top是这一页在拼接图中的y像素位置
+        """
+        zoom = dpi / 72
+        origin_x, origin_y = (clip.x0, clip.y0) if clip is not None else (0, 0)
+        return OcrLine(item['text'],
+                       item.get('left', 0) / zoom + origin_x,
+                       (item.get('top', 0) - top) / zoom + origin_y,
+                       item.get('right', 0) / zoom + origin_x,
+                       (item.get('bottom', 0) - top) / zoom + origin_y)
+
+    def ocr_pixmap(self, pix, page, dpi=300, clip=None) -> List[OcrLine]:
+        return [self._to_line(item, dpi, clip) for item in self._ocr_png(pix)]
+
+    def ocr_pixmaps(self, pixmaps, pages, dpi=300, clip=None) -> List[List[OcrLine]]:
+        """
+        把多页的图片从上到下拼成一张图(页之间留stitch_gap像素的空白)，一次wcocr调用识别，再按每行中心的y坐标分回各页。
+        每次调用wcocr都要写一次临时文件、和WeChatOCR.exe通信一次，拼起来后多页只需要一次。拼成的图超过stitch_max_height时分成几张图
+        """
+        page_lines = []
+        start = 0
+        while start < len(pixmaps):
+            end = start + 1
+            height = pixmaps[start].height
+            while end < len(pixmaps) and height + self.stitch_gap + pixmaps[end].height <= self.stitch_max_height:
+                height += self.stitch_gap + pixmaps[end].height
+                end += 1
+            if end - start == 1:
+                page_lines.append(self.ocr_pixmap(pixmaps[start], pages[start], dpi, clip))
+                start = end
+                continue
+            canvas = fitz.Pixmap(pixmaps[start].colorspace, fitz.IRect(0, 0, max(pix.width for pix in pixmaps[start:end]), height), False)
+            canvas.clear_with(255)
+            tops = []
+            top = 0
+            for pix in pixmaps[start:end]:
+                pix.set_origin(0, top)
+                canvas.copy(pix, pix.irect)
+                tops.append(top)
+                top += pix.height + self.stitch_gap
+            lines = [[] for _ in tops]
+            for item in self._ocr_png(canvas):
+                center_y = (item.get('top', 0) + item.get('bottom', 0)) / 2
+                i = max(bisect_right(tops, center_y) - 1, 0)
+                lines[i].append(self._to_line(item, dpi, clip, tops[i]))
+            page_lines.extend(lines)
+            start = end
+        return page_lines
+
+
+class TextLayerStubBackend(OcrBackend):
+    """
+    本地桩ocr：不看图片，直接把pdf文字层的每一行当作ocr结果返回，结果是确定的。
+    不需要Windows和WeChatOCR.exe，用于在Linux上测试和压测整个提取流程。
+    clip不为None时只返回和clip区域有重叠的行，和真实ocr只识别渲染区域的行为一致。
+    """
+    name = "stub"
+
+    def ocr_pixmap(self, pix, page, dpi=300, clip=None) -> List[OcrLine]:
+        lines = []
+        for block in page.get_text("dict", sort=True)["blocks"]:
+            for line in block.get("lines", []):
+                text = "".join(span["text"] for span in line["spans"]).strip()
+                if text == "":
+                    continue
+                rect = fitz.Rect(line["bbox"])
+                if clip is not None and not rect.intersects(clip):
+                    continue
+                lines.append(OcrLine(text, rect.x0, rect.y0, rect.x1, rect.y1))
+        return lines
@@ -0,0 +1,249 @@
+import os
+import sys
+sys.dont_write_bytecode = True
+import csv
+import time
+import random
+import argparse
+import tempfile
+import fitz  # PyMuPDF
+from metrics import percentiles
+import run_log
+
+"""
+性能测试：用PyMuPDF按readme_pic1.png中的电子发票格式生成模拟发票，
+然后测试process_pdf_folder整体的吞吐量(张/秒)和field_specs中每个字段的提取耗时分位数，以及进程的内存峰值。
+默认用stub ocr后端(直接返回pdf文字层)，不需要微信ocr，可以在Linux上运行。
+用法：python benchmark.py --count 200
+"""
+
+font_name = "china-s"  # PyMuPDF内置的简体中文字体
+digits_upper = "零壹贰叁肆伍陆柒捌玖"
+
+
+def _random_tax_id(rng:random.Random):
+    return "91" + "".join(rng.choice("0123456789") for _ in range(6)) + "".join(rng.choice("0123456789ABCDEFGHJKLMNPQRTUWXY") for _ in range(10))
+
+def _random_company(rng:random.Random):
+    city = rng.choice(["北京","上海","广州","深圳","杭州","成都"])
+    name = "".join(rng.choice("华信达通泰安恒瑞博远诚创新源") for _ in range(rng.randint(2, 4)))
+    kind = rng.choice(["科技有限公司","贸易有限公司","信息技术有限公司","建设工程有限公司"])
+    return city + name + kind
+
+def _da_xie(amount:float):
+    """
+    金额的大写，只用于填充版面，不要求符合财务规范
+    """
+    return "".join(digits_upper[int(c)] for c in str(int(amount))) + "圆整"
+
+def make_invoice(pdf_path:str, rng:random.Random, variant:str="normal", item_rows:int=3):
+    """
+    生成一张模拟电子发票，返回写入的字段(用于核对提取结果)。
+    variant:
+        normal: 标准的一页发票
+        multi_page: 前面多一页商品清单，发票在最后一页
+        no_bei_zhu: 没有备注内容
+        inline_amount: 价税合计和金额在同一个文本块里
+        image_only: 只有图片没有文字层(扫描件)
+    item_rows: 商品明细的行数，行数多时版面上的文本块多
+    """
+    fa_piao_lei_xing = rng.choice(["普通发票","增值税专用发票"])
+    fa_piao_hao_ma = "".join(rng.choice("0123456789") for _ in range(20))
+    buyer, buyer_tax_id = _random_company(rng), _random_tax_id(rng)
+    seller, seller_tax_id = _random_company(rng), _random_tax_id(rng)
+    amount = round(rng.uniform(10, 100000), 2)
+    contract_number = "".join(rng.choice("0123456789") for _ in range(8))
+    bei_zhu = "" if variant == "no_bei_zhu" else f"合同编号：BS{contract_number}"
+
+    doc = fitz.open()
+    if variant == "multi_page":
+        page = doc.new_page(width=595, height=842)
+        page.insert_text((40, 60), "销售货物或者提供应税劳务清单", fontname=font_name, fontsize=14)
+        for i in range(30):
+            page.insert_text((40, 100 + i * 22), f"清单第{i+1}行  商品{i+1}  1  {rng.uniform(1, 1000):.2f}", fontname=font_name, fontsize=9)
+    page = doc.new_page(width=760, height=420)
+    texts = []
+    def text(x, y, s, size=9):
+        texts.append((x, y, s, size))
+    text(200, 40, f"电子发票（{fa_piao_lei_xing}）", 14)
+    text(520, 40, f"发票号码：{fa_piao_hao_ma}")
+    text(520, 56, "开票日期：2025年02月03日")
+    page.draw_rect(fitz.Rect(20, 70, 740, 140))
+    for i, c in enumerate("购买方信息"):  # 竖排的标签
+        text(30, 84 + i * 11, c, 8)
+    text(60, 95, f"名称：{buyer}")
+    text(60, 120, f"统一社会信用代码/纳税人识别号：{buyer_tax_id}")
+    for i, c in enumerate("销售方信息"):
+        text(390, 84 + i * 11, c, 8)
+    text(420, 95, f"名称：{seller}")
+    text(420, 120, f"统一社会信用代码/纳税人识别号：{seller_tax_id}")
+    text(30, 160, "项目名称")
+    text(200, 160, "数量")
+    text(300, 160, "金额")
+    text(450, 160, "税额")
+    row_height = min(14, 120 / max(item_rows, 1))
+    for i in range(item_rows):
+        y = 178 + i * row_height
+        text(30, y, f"*服务*项目{i+1}", 7)
+        text(200, y, "1", 7)
+        text(300, y, f"{amount / item_rows:.2f}", 7)
+        text(450, y, f"{amount * 0.06 / item_rows:.2f}", 7)
+    if variant == "inline_amount":
+        text(30, 320, f"价税合计（大写）{_da_xie(amount)}（小写）¥{amount:,.2f}")
+    else:
+        text(30, 320, "价税合计（大写）")
+        text(150, 320, _da_xie(amount))
+        text(520, 319, f"（小写）¥{amount:,.2f}", 10)  # 金额的字号比标签大，y范围和价税合计不完全相同
+    text(30, 350, "备")
+    text(30, 362, "注")
+    if bei_zhu:
+        text(100, 356, bei_zhu)
+    text(30, 400, "开票人：张三")
+    # MuPDF会把内容流中相邻且位置接近的文字合成一个block。按列写入，同一行不同列的文字就不会合成一个block，和真实发票的blocks一致
+    for x, y, s, size in sorted(texts):
+        page.insert_text((x, y), s, fontname=font_name, fontsize=size)
+
+    if variant == "image_only":  # 把发票页渲染成图片，再放到一个没有文字层的新pdf中
+        pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
+        image_doc = fitz.open()
+        image_page = image_doc.new_page(width=page.rect.width, height=page.rect.height)
+        image_page.insert_image(image_page.rect, pixmap=pix)
+        doc.close()
+        doc = image_doc
+    doc.save(pdf_path)
+    doc.close()
+    return {
+        "发票类型":fa_piao_lei_xing,
+        "发票号码":fa_piao_hao_ma,
+        "名称税号":[buyer, buyer_tax_id, seller, seller_tax_id],
+        "合计金额":amount,
+        "备注":bei_zhu,
+        "合同编号":contract_number if bei_zhu else "",
+    }
+
+variant_weights = {"normal":0.7, "multi_page":0.1, "no_bei_zhu":0.08, "inline_amount":0.1, "image_only":0.02}
+
+def make_invoices(folder:str, count:int, seed:int=0, max_item_rows:int=40):
+    """
+    在folder中生成count张模拟发票，各种variant按variant_weights的比例出现。返回{pdf绝对路径:写入的字段}
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = random.Random(seed)
+    expected = {}
+    variants = list(variant_weights)
+    weights = [variant_weights[v] for v in variants]
+    for i in range(count):
+        variant = rng.choices(variants, weights)[0]
+        pdf_path = os.path.abspath(os.path.join(folder, f"invoice_{i:06d}_{variant}.pdf"))
+        expected[pdf_path] = make_invoice(pdf_path, rng, variant, rng.randint(1, max_item_rows))
+        expected[pdf_path]["variant"] = variant
+    return expected
+
+def peak_rss_mb():
+    """
+    本进程(以及已经结束的子进程)的内存峰值，单位MB。Windows上没有resource模块时返回None
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    self_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024  # macOS上单位是字节，Linux上是KB
+    return max(self_peak, children_peak) / scale
+
+def bench_extractors(extract, pdf_paths):
+    """
+    对每张发票单独提取field_specs中的每个字段，返回{阶段名:[耗时秒,...]}。
+    ocr_texts用stub后端的ocr结果，ocr本身的耗时单独记在"ocr"中，打开pdf和解析blocks记在"PdfLayout"中，
+    所有字段共用的一次遍历blocks记在"PageScan"中
+    """
+    import OCR
+    timings = {"PdfLayout":[], "ocr":[], "PageScan":[]}
+    for pdf_path in pdf_paths:
+        start = time.perf_counter()
+        layout = extract.PdfLayout(pdf_path)
+        timings["PdfLayout"].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        ocr_texts = OCR.ocr_pdf_pages(layout.doc, [-1])[0]
+        timings["ocr"].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        layout.scan
+        timings["PageScan"].append(time.perf_counter() - start)
+        for field in extract.field_specs:
+            start = time.perf_counter()
+            extract.extract_fields([field], ocr_texts, layout)
+            timings.setdefault(field, []).append(time.perf_counter() - start)
+        layout.close()
+    return timings
+
+def check_results(csv_path, expected):
+    """
+    比较fa_piao_info.csv和生成发票时写入的字段，返回(正确的发票数,有结果的发票数)
+    """
+    correct = 0
+    total = 0
+    with open(csv_path, "r", encoding="utf8") as file:
+        for row in csv.DictReader(file):
+            exp = expected.get(row["PDF绝对路径"])
+            if exp is None:
+                continue
+            total += 1
+            if (row["发票号码"] == exp["发票号码"]
+                    and [row["购买方名称"], row["购买方纳税人识别号"], row["销售方名称"], row["销售方纳税人识别号"]] == exp["名称税号"]
+                    and row["价税合计金额"] != "" and abs(float(row["价税合计金额"]) - exp["合计金额"]) < 0.005
+                    and row["合同编号"] == exp["合同编号"]):
+                correct += 1
+    return correct, total
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark invoice extraction on synthetic e-invoices.")
+    parser.add_argument("--count", type=int, default=100, help="Number of synthetic invoices to generate.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the generator.")
+    parser.add_argument("--folder", type=str, default=None, help="Folder for the generated invoices. A temporary folder is used by default.")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes for process_pdf_folder.")
+    parser.add_argument("--ocr_backend", type=str, default="stub", help="OCR backend used by the benchmark.")
+    parser.add_argument("--extract_mode", type=str, default="text_first", choices=["text_first","ocr"])
+    args = parser.parse_args()
+
+    import OCR
+    OCR.set_backend(args.ocr_backend)
+    import extract
+    extract.ocr_backend = args.ocr_backend
+    extract.extract_mode = args.extract_mode
+    extract.use_cache = False  # 测的是提取本身，不能用缓存
+
+    work_folder = tempfile.mkdtemp(prefix="fa_piao_bench_")
+    extract.invoice_index_file = os.path.join(work_folder, "invoice_index.sqlite3")  # 同一个seed生成的发票号码一样，不能和以前的运行共用索引
+    extract.sqlite_file = os.path.join(work_folder, "fa_piao.sqlite3")
+    input_folder = args.folder or os.path.join(work_folder, "invoices")
+    extract.input_folder = input_folder
+    start = time.perf_counter()
+    expected = make_invoices(input_folder, args.count, args.seed)
+    print(f"生成{args.count}张模拟发票：{time.perf_counter() - start:.2f}s  {input_folder}")
+
+    extract.this_time_output_folder = os.path.join(work_folder, "outputs")
+    os.makedirs(extract.this_time_output_folder, exist_ok=True)
+    run_log.setup_logging(extract.this_time_output_folder, console=False)  # 提取过程的日志不输出到命令行
+    try:
+        start = time.perf_counter()
+        extract.process_pdf_folder(input_folder, args.workers)
+        elapsed = time.perf_counter() - start
+        extractor_timings = bench_extractors(extract, sorted(expected))
+    finally:
+        run_log.shutdown_logging()
+
+    correct, total = check_results(os.path.join(extract.this_time_output_folder, "fa_piao_info.csv"), expected)
+    print(f"process_pdf_folder: {args.count}张 {elapsed:.2f}s  {args.count / elapsed:.1f}张/s  workers={args.workers}")
+    print(f"完全正确的发票：{correct}/{total}")
+    print(f"{'阶段':<24}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}")
+    for name, values in extractor_timings.items():
+        p = percentiles(values)
+        print(f"{name:<24}{p[50]*1000:>10.2f}{p[95]*1000:>10.2f}{p[99]*1000:>10.2f}")
+    rss = peak_rss_mb()
+    if rss is not None:
+        print(f"内存峰值：{rss:.1f}MB")
+    print(f"输出：{extract.this_time_output_folder}")
+
+if __name__ == "__main__":
+    main()
@@ -6,15 +6,65 @@ sys.dont_write_bytecode = True
 from typing import List
 import fitz  # PyMuPDF
 import OCR
-import difflib
 import csv
 import argparse
+import json
+import sqlite3
+import concurrent.futures
+import queue
+import contextlib
+import functools
+import threading
+import signal
+import socketserver
+import cProfile
+import pstats
+import io
+import multiprocessing.util
+import metrics
+import run_log
+from result_cache import ResultCache
+from fuzzy_index import FuzzyIndex
+from spatial_index import SpatialIndex
+from invoice_index import InvoiceIndex, format_amount
+from sqlite_sink import SqliteSink
 
 
 max_retry_time = 5
+# ocr重试的渲染参数，第i次ocr用第i组参数。同样的参数重试得到的结果是一样的，所以每次换一种dpi、颜色或者只渲染页面上半部分(发票号码和名称税号都在上半部分)
+ocr_retry_ladder = [
+    {"dpi":300, "colorspace":fitz.csGRAY, "clip_top":None},
+    {"dpi":400, "colorspace":fitz.csGRAY, "clip_top":None},
+    {"dpi":300, "colorspace":fitz.csRGB, "clip_top":None},
+    {"dpi":450, "colorspace":fitz.csGRAY, "clip_top":0.6},  # clip_top:只渲染页面顶部的这个比例
+    {"dpi":200, "colorspace":fitz.csGRAY, "clip_top":None},
+]
+clip_top_fields = {"发票号码","名称税号"}  # 在页面顶部的字段。只渲染顶部的那次ocr，只用于没提取到的字段都在这里面的页，否则跳过这一组参数
+extract_mode = "text_first"  # text_first: 先用pdf文字层提取，只有文字层提取不到的字段才ocr; ocr: 所有字段都先ocr
 input_folder = r"发票"  # 输入PDF文件的文件夹路径
 output_folder = "outputs"
 this_time_output_folder = None  #如果为None 会设置成 output_folder_本次运行时间
+cache_folder = "cache"  # 提取结果缓存的文件夹，跨多次运行使用
+cache_max_mb = 512  # 缓存最大占用的空间，超过后删除最久没用过的结果
+use_cache = True  # --no_cache 时为False
+rebuild_cache = False  # --rebuild_cache 时为True，不读旧缓存，重新提取并写入缓存
+ocr_backend = OCR.backend_name  # ocr后端，见OCR.backends。stub后端直接返回pdf文字层，可以在没有微信ocr的机器上测试
+profile = False  # --profile 时为True，用cProfile统计函数耗时
+log_level = "INFO"  # 日志级别，低于这个级别的日志不输出
+log_background = False  # True时由后台线程写日志文件，见run_log.setup_logging
+text_min_chars = 20  # 最后一页文字层少于这么多字时认为是图片型pdf，见classify_pdf
+image_min_coverage = 0.5  # 有文字层，但图片覆盖了这个比例以上的页面时认为是混合型pdf
+watch_interval = 2.0  # --watch时每隔多少秒扫描一次输入文件夹
+duplicates_mode = "flag"  # 重复的发票(见invoice_index.py)：flag: 照常写入csv，同时记录在duplicates.csv中；skip: 只记录在duplicates.csv中；off: 不检查
+invoice_index_file = os.path.join(output_folder,"invoice_index.sqlite3")  # 跨多次运行的发票索引，用来发现重复的发票
+output_formats = ["csv","sqlite"]  # csv: 每次运行的fa_piao_info.csv；sqlite: 所有运行的结果都写到sqlite_file中，见sqlite_sink.py
+sqlite_file = os.path.join(output_folder,"fa_piao.sqlite3")
+sqlite_batch_size = 500  # 每攒够这么多行在一个事务中写入sqlite
+ocr_only_confidence = 0.6  # 图片型、混合型pdf用ocr识别出的行提取的字段，没有文字层可以核对，置信度用这个值
+duplicate_confidence = 0.9  # 从重复发票的原发票复制过来的字段的置信度
+watch_output_folder_name = "watch"  # --watch/--stdin/--listen 时固定输出到outputs/watch，重启后接着写，已经处理过的pdf不会重复处理
+split_pages = False  # --split_pages 时为True：一个pdf中有多张发票(或者发票后面跟着清单页)时，每一页发票都提取一行，见extract_pdf_info
+extractor_version = "4"  # 提取逻辑有改动(会影响提取结果)时要改这个版本号，旧的缓存就不会再被使用
 
 
 """
@@ -25,31 +75,10 @@ description: 本脚本用于提取PDF文件中的发票信息，包括发票类
 1. 首先阅读：if __name__ == "__main__": 这个部分，这个部分是程序的入口，是整个程序的主要逻辑。
     它最后调用process_pdf_folder(input_folder)这个函数，这个函数是整个程序的核心，是用来提取PDF文件中的发票信息的。
 2. 然后阅读：process_pdf_folder(input_folder) 这个函数。这个函数里面有注释。会引导你读其他函数。
-3. 然后阅读field_func_maps(位于process_pdf_folder上方)中罗列的函数:每个函数前面的注释会告诉你这个函数是用来提取什么信息的，
-    以及提取信息的方法。
+3. 然后阅读field_specs(位于process_pdf_folder上方)中每个字段的提取规则:FieldSpec的注释会告诉你每种relation是怎样提取信息的。
 """
-def set_runing_log_output(output_log_file):
-    """
-    设置同时向命令行和文件输出日志
-    """
-    class Tee(object):
-        def __init__(self, *files):
-            self.files = files
-
-        def write(self, obj):
-            for f in self.files:
-                f.write(obj)
-                f.flush()
-
-        def flush(self):
-            for f in self.files:
-                f.flush()
-
-    tee = Tee(sys.stdout, output_log_file)
-    sys.stdout = tee
-
-warning_file = None
-error_file = None
+logger = run_log.logger
+whitespace_pattern = re.compile(r'\s+')
 
 def format_str(s:str):
     """
@@ -80,338 +109,1117 @@ def split_texts(texts):
     
     return result
 
-def get_pdf_texts(pdf_path):
-   """
-   辅助函数：获取PDF文件中的文本
-   """
-   doc = fitz.open(pdf_path)
-   pdf_page_texts = []
-   for page in doc:
-        blocks = page.get_text("blocks", sort=True)
-        texts = []
-        for block in blocks:
-            x0, y0, x1, y1, text, block_no, block_type = block
-            text = text.strip()
-            texts.append(text)
-        pdf_page_texts.append(texts)
-   return pdf_page_texts
-
-def print_error(pdf_path:str,ocr_texts:List[str],pdf_texts:List[str],func_name:str,other_info:str=""):
-    """
-    辅助函数：打印错误信息
-    """
-    print(f"~~~~~~~{func_name}_error:{pdf_path}~~~~~~~~")
-    print(ocr_texts)
-    print("=====ocr_texts↑  pdf_texts↓=====")
-    print(pdf_texts)
-    print(f"other_info:{other_info}")
-    print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-
-def valid_field(field_value:str,pdf_texts:List[str],pdf_path):
+class PdfLayout(object):
+    """
+    一张发票PDF(一页)的版面信息。
+    PDF只打开一次，发票页(默认最后一页)的blocks也只解析一次，所有字段的提取(field_specs)和OCR共享这个对象，重试时也不用重新解析。
+    blocks: [(text,x0,y0,x1,y1),...]，text是去掉首尾空白后的文本，(x0,y0)是左上角坐标，(x1,y1)是右下角坐标
+    compact_texts: 每个block去掉所有空白字符后的文本，与blocks一一对应
+    texts: 每个block的文本
+    图片型pdf没有文字层，ocr后用use_ocr_lines把ocr识别出的行(带坐标)当作blocks，提取函数不用改
+    """
+    def __init__(self, pdf_path, pdf_bytes=None, page_number=-1, doc=None):
+        """
+        pdf_bytes不为None时直接从内存中的pdf字节打开，不再读文件
+        page_number: 第几页(从0开始，支持负数下标)，默认最后一页
+        doc不为None时使用这个已经打开的fitz.Document(多发票模式下同一个pdf的各页共用)，close时不会关闭它
+        """
+        self.pdf_path = pdf_path
+        self.own_doc = doc is None
+        with metrics.stage("pdf_open"):
+            if doc is None:
+                doc = fitz.open(pdf_path) if pdf_bytes is None else fitz.open(stream=pdf_bytes, filetype="pdf")
+            self.doc = doc
+            self.page_number = page_number if page_number >= 0 else len(doc) + page_number
+            self.page = self.doc[self.page_number]
+        with metrics.stage("text_blocks"):
+            blocks = self.page.get_text("blocks", sort=True)
+        self.text_layer_blocks = [(text.strip(),x0,y0,x1,y1) for x0, y0, x1, y1, text, block_no, block_type in blocks]
+        self.match_scores = []  # valid_field每次在pdf文本中找到ocr文本时的相似度(原样找到为1)，用来计算字段的置信度
+        self.set_blocks(self.text_layer_blocks)
+
+    def set_blocks(self, blocks):
+        """
+        设置提取字段使用的blocks，同时更新compact_texts、texts，模糊匹配索引、空间索引和PageScan下次用到时重建
+        """
+        self.blocks = blocks
+        self.compact_texts = [whitespace_pattern.sub('', b[0]) for b in blocks]
+        self.texts = [b[0] for b in blocks]
+        self._fuzzy_index = None
+        self._spatial_index = None
+        self._scan = None
+
+    def use_ocr_lines(self, ocr_lines, keep_text_layer=False):
+        """
+        用ocr识别出的行(OCR.OcrLine，坐标已经是页面坐标)作为blocks，和get_text("blocks", sort=True)一样按从上到下、从左到右排序。
+        keep_text_layer为True时(混合型pdf)保留文字层的blocks，只加入文字层里没有的ocr行，避免同一个文本出现两次
+        """
+        blocks = list(self.text_layer_blocks) if keep_text_layer else []
+        layer_text = "\n".join(whitespace_pattern.sub('', b[0]) for b in blocks)
+        for line in ocr_lines:
+            text = line.text.strip()
+            if text == "" or (keep_text_layer and layer_text.find(whitespace_pattern.sub('', text)) != -1):
+                continue
+            blocks.append((text,line.x0,line.y0,line.x1,line.y1))
+        blocks.sort(key=lambda b: (b[2], b[1]))
+        self.set_blocks(blocks)
+
+    @property
+    def fuzzy_index(self):
+        """
+        本页文本的模糊匹配索引，第一次用到时才建，所有字段共用
+        pdf_texts中的每行文本中间可能含有空白字符，比如["123456\n7890","发票代码","123455"]，需要拆分成["123456","7890","发票代码","123455"]
+        """
+        if self._fuzzy_index is None:
+            self._fuzzy_index = FuzzyIndex(split_texts(self.texts))
+        return self._fuzzy_index
+
+    @property
+    def spatial_index(self):
+        """
+        本页blocks的空间索引(见spatial_index.py)，按行、按矩形区域查找blocks，以及查找包含某个文本的block，第一次用到时才建，所有字段共用
+        """
+        if self._spatial_index is None:
+            with metrics.stage("spatial_index"):
+                self._spatial_index = SpatialIndex(self.blocks,self.compact_texts)
+        return self._spatial_index
+
+    @property
+    def scan(self):
+        """
+        一次遍历blocks得到的锚点位置等信息(PageScan)，第一次用到时才算，所有字段共用
+        """
+        if self._scan is None:
+            self._scan = PageScan(self)
+        return self._scan
+
+    def close(self):
+        if self.own_doc:
+            self.doc.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def valid_field(field_value:str,layout:PdfLayout):
     """
     ocr识别的文本可能会有误差，所以我们需要验证一下识别的文本是否正确。
-    field_value是ocr识别的文本，pdf_texts是pdf中的文本。
+    field_value是ocr识别的文本，layout.texts是pdf中的文本。
     格式化：把所有的英文符号替换成中文符号，比如把英文逗号替换成中文逗号，通过这样，可以在比较时忽略中英文符号的差异。
-    从pdf_texts中找到field_value中格式化后相同的字符串。如果找不到，返回pdf_texts中最相似的字符串
-    
+    从pdf_texts中找到field_value中格式化后相同的字符串。如果找不到，返回pdf_texts中最相似的字符串(用layout.fuzzy_index查找)。
+    相似度都低于0.8时返回None，由调用者处理
+    pdf文本格式化后的结果在layout.scan中，每页只格式化一次
     """
     f_field_value = format_str(str(field_value))
-    for text in pdf_texts:
-        f_text = format_str(text)
+    for text, f_text in zip(layout.texts,layout.scan.formatted_texts):
         pos = f_text.find(f_field_value)
         if pos != -1:
+            layout.match_scores.append(1.0)
             return text[pos:pos+len(f_field_value)]
-    new_pdf_texts  = split_texts(pdf_texts)  # pdf_texts中的每行文本中间可能含有空白字符，比如["123456\n7890","发票代码","123455"]，需要拆分成["123456","7890","发票代码","123455"]
-    most_like = difflib.get_close_matches(field_value,new_pdf_texts,1,0.8)[0]
-    print(f"warning:{pdf_path} change {field_value} to {most_like}")
-    warning_file.write(f"{pdf_path} change {field_value} to {most_like}\n")
+    with metrics.stage("valid_field_fuzzy"):
+        match = layout.fuzzy_index.best_match(str(field_value),0.8)
+    if match is None:
+        logger.warning(f"{layout.pdf_path} can't find {field_value} in pdf texts")
+        return None
+    most_like = match.text
+    layout.match_scores.append(match.score)
+    logger.warning(f"{layout.pdf_path} change {field_value} to {most_like} score:{match.score:.2f}")
     return most_like
 
-def get_bei_zhu(ocr_texts,pdf_texts:List[str],pdf_path):
-    """
-    获取备注。
-    基本 思想：备注的文本在价税合计和开票人之间，在"备注"这个文本的右边。
-    工具：fitz page.get_text("blocks", sort=True) 不仅可以返回文本，还可以返回文本的坐标。
-    一个文本的坐标是(x0,y0,x1,y1)，其中(x0,y0)是文本的左上角坐标，(x1,y1)是文本的右下角坐标。
-    具体步骤：找到价税合计这个文本的右下角顶点的y坐标:bei_zhu_area_y0
-    找到开票人这个文本的左上角顶点的y坐标:bei_zhu_area_y1
-    那么备注的文本的y坐标范围就是[bei_zhu_area_y0,bei_zhu_area_y1]
-    然后找到备注这两个字的文本的右下角顶点的x坐标:bei_zhu_area_x0
-    那么备注的文本的x坐标范围就是[bei_zhu_area_x0,∞)
-    在这个范围内的文本就是备注的文本
-    """
-    doc = fitz.open(pdf_path)
-    page  = doc[-1]
-    blocks = page.get_text("blocks", sort=True)
-    my_blocks = []
-    bei_zhu_area_y0 = 0
-    bei_zhu_area_y1 = 0
-    bei_zhu_area_x0 = 0
-    bz_text = ""
-    for block in blocks:
-        x0, y0, x1, y1, text, block_no, block_type = block
-        text:str
-        text = text.strip()
-        if(text.find("价税合计")!=-1):
-            bei_zhu_area_y0 = y1
-        if(text.find("开票人")!=-1):
-            bei_zhu_area_y1 = y0
-        if text=="备" or text.replace("\n","") == "备注":
-            bei_zhu_area_x0 = x1
-        my_blocks.append((text,x0,y0,x1,y1))
-    if bei_zhu_area_y0 == 0 or bei_zhu_area_y1 == 0 or bei_zhu_area_x0 == 0:
-        print(f"~~~~~~~~get_bei_zhu_error:{pdf_path}~~~~~~~~~~~~")
-        print(f"x0,y0,y1 = {bei_zhu_area_x0} {bei_zhu_area_y0} {bei_zhu_area_y1}")
-        for b in my_blocks:
-            print(b)
-        print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-        return ""
-    
-    for b in my_blocks:
-        if b[2] > bei_zhu_area_y0 and b[4] < bei_zhu_area_y1 and b[1] > bei_zhu_area_x0:
-            bz_text += b[0].replace("\n","")
-    return bz_text
-
-def get_fa_piao_hao_ma(ocr_texts,pdf_texts:List[str],pdf_path):
+def valid_shun_xu(ming_cheng_shui_hao,layout:PdfLayout):
     """
-    提取发票号码。
-    """
-    text = "".join(ocr_texts)
-    invoice_number_search = re.search(r'发票号码[:：]?\s*(\d+)', text)
-    invoice_number = invoice_number_search.group(1).strip() if invoice_number_search else None
-    if invoice_number is not None:
-        res = valid_field(invoice_number,pdf_texts,pdf_path)
-        if res is None:
-            print_error(pdf_path,ocr_texts,pdf_texts,"get_fa_piao_hao_ma",f"not valid:{invoice_number}")
-        return res
-    print_error(pdf_path,ocr_texts,pdf_texts,"get_fa_piao_hao_ma",f"can't not find 发票号码")            
-    return None
-
-def valid_shun_xu(ming_cheng_shui_hao,pdf_path):
-    """
-    这个是get_ming_cheng_sui_hao的辅助函数。请先了解get_ming_cheng_sui_hao的注释。
-    函数功能：确保购买方在前，销售方在后。
+    名称税号的辅助函数，函数功能：确保购买方在前，销售方在后。
     通过文本的x坐标来判断。购买方的x坐标一定小于销售方的x坐标。
-    通过get_text("blocks", sort=True)  不仅可以获取文本内容，还可以获取文本的坐标。
+    通过get_text("blocks", sort=True)  不仅可以获取文本内容，还可以获取文本的坐标。layout里已经保存了去掉空白字符后的文本(compact_texts)和坐标(blocks)。
+    4个内容所在的块用layout.spatial_index.locate查找(包含这个内容的最后一个块)，不用每个块都find 4次
     """
     # 首先找到ming_cheng_shui_hao中4个内容所在的块
-    doc = fitz.open(pdf_path)
-    page  = doc[-1]
-    blocks = page.get_text("blocks", sort=True)
-    my_blocks = []
-    ming_cheng_shui_hao_shun_xu = [(ming_cheng_shui_hao[0],None),(ming_cheng_shui_hao[1],None),(ming_cheng_shui_hao[2],None),(ming_cheng_shui_hao[3],None)]
-    for block in blocks:
-        x0, y0, x1, y1, text, block_no, block_type = block
-        text:str
-        text = text.strip()
-        text = re.sub(r'\s+', '', text)
-        my_blocks.append((text,x0,y0,x1,y1))
-        if(text.find(ming_cheng_shui_hao[0])!=-1):
-            ming_cheng_shui_hao_shun_xu[0] = (ming_cheng_shui_hao[0],x0)
-        if(text.find(ming_cheng_shui_hao[1])!=-1):
-            ming_cheng_shui_hao_shun_xu[1] = (ming_cheng_shui_hao[1],x0)
-        if(text.find(ming_cheng_shui_hao[2])!=-1):
-            ming_cheng_shui_hao_shun_xu[2] = (ming_cheng_shui_hao[2],x0)
-        if(text.find(ming_cheng_shui_hao[3])!=-1):
-            ming_cheng_shui_hao_shun_xu[3] = (ming_cheng_shui_hao[3],x0)
+    ming_cheng_shui_hao_shun_xu = []
+    for value in ming_cheng_shui_hao:
+        block_index = layout.spatial_index.locate(value)
+        ming_cheng_shui_hao_shun_xu.append((value,layout.blocks[block_index][1] if block_index is not None else None))
     if ming_cheng_shui_hao_shun_xu[0][1] is None or ming_cheng_shui_hao_shun_xu[1][1] is None or ming_cheng_shui_hao_shun_xu[2][1] is None or ming_cheng_shui_hao_shun_xu[3][1] is None:
-        print(f"~~~~~~~~valid_shun_xu_error:{pdf_path}~~~~~~~~~~~~")
-        print("无法确定名称税号4个字段的顺序")
-        for b in my_blocks:
-            print(b)
-        print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
+        run_log.note(layout.pdf_path,"valid_shun_xu",f"无法确定名称税号4个字段的顺序:{ming_cheng_shui_hao_shun_xu}")
         return None
     if ming_cheng_shui_hao_shun_xu[0][1] > ming_cheng_shui_hao_shun_xu[2][1]:
         ming_cheng_shui_hao[0], ming_cheng_shui_hao[2] = ming_cheng_shui_hao[2], ming_cheng_shui_hao[0]
     if ming_cheng_shui_hao_shun_xu[1][1] > ming_cheng_shui_hao_shun_xu[3][1]:
         ming_cheng_shui_hao[1], ming_cheng_shui_hao[3] = ming_cheng_shui_hao[3], ming_cheng_shui_hao[1]
     return ming_cheng_shui_hao
-def get_ming_cheng_sui_hao(ocr_texts,pdf_texts:List[str],pdf_path):
-    """
-    提取名称税号,首先通过ocr识别文本。找到名称:xxxxx  xxxx就是我们要的信息。
-    找到识别号:xxxxx   xxxx也是我们要的信息。
-    我们要找到两个名称和税号。
-    但我们并不知道这两个名称和税号哪两个是销售方哪两个是购买方的。
-    此时我们可以通过这两个文本的位置来判断。
-    我们通过valid_shun_xu函数来确保购买方在前，销售方在后
-    """
-    text = "\n".join(ocr_texts)
-    name_search = re.findall(r'名\s*称[:：]+\s*(\S+)', text)
-    tax_id_search = re.findall(r'识别号[:：]?\s*(\S+)', text)
-    if len(name_search) == 2 and len(tax_id_search) == 2:
-        field_res = [name_search[0].strip(),tax_id_search[0].strip(),name_search[1].strip(),tax_id_search[1].strip()]
+
+# 字段的提取规则：每个字段用一个FieldSpec声明锚点、正则、值和锚点的位置关系、校验方式，都放在field_specs中。
+# 程序启动时创建field_specs，正则只编译一次；提取时先一次遍历blocks得到PageScan(所有锚点的位置等)，所有字段共用，
+# 再按每个字段的relation取值(见FieldSpec.extract)。新增字段只需要在field_specs中加一项，不用再写一个遍历整页的函数。
+
+anchor_texts = {
+    "发票号码":"发票号码",
+    "价税合计":"价税合计",
+    "开票人":"开票人",
+    "备注":("备","备注"),
+}   # 锚点名:锚点文本。字符串表示block(去掉空白后)包含这个文本；元组表示block去掉空白后等于其中之一
+
+anchor_missing = object()  # FieldSpec.extract找不到锚点(或"page_text"没有匹配)时的返回值
+
+class FieldSpec(object):
+    """
+    一个字段的提取规则。
+    field: res_dict中的字段名
+    relation: 值和锚点的位置关系，也就是去哪里找值：
+        "page_text": 第一个匹配pattern的block(发票类型)，找不到时为default
+        "ocr": 在ocr文本中用pattern找，再到pdf文本中核对(valid_field)；文字层优先时直接在pdf文本中找，值要满足text_layer_format
+        "pairs": 和"ocr"一样，但pattern是(名称,识别号)两个正则，都要正好找到两个，再用valid_shun_xu按x坐标确定购买方和销售方
+        "same_row": 在anchors[0]这个block中，或者和它在同一行(y范围有重合)的blocks中找pattern，要正好找到一个(合计金额)
+        "right_of_between": anchors[0]下面、anchors[1]上面、anchors[2]右边的blocks的文本连起来(备注)
+    pattern: 正则(字符串，创建时编译)，第1个分组是值。"pairs"时是两个正则的元组
+    anchors: 用到的锚点名(见anchor_texts)。锚点找不到时用default
+    ocr_join: 拼接ocr文本用的分隔符
+    text_layer_format: 文字层优先提取时，值要完全匹配这个正则才采用("pairs"时用来校验识别号)
+    convert: 把找到的字符串转换成字段的值，比如金额转换成float
+    """
+    def __init__(self, field, relation, pattern=None, anchors=(), ocr_join="", text_layer_format=None, convert=None, default=None):
+        self.field = field
+        self.relation = relation
+        if isinstance(pattern,tuple):
+            self.pattern = tuple(re.compile(p) for p in pattern)
+        else:
+            self.pattern = re.compile(pattern) if pattern is not None else None
+        self.anchors = anchors
+        self.ocr_join = ocr_join
+        self.text_layer_format = re.compile(text_layer_format) if text_layer_format is not None else None
+        self.convert = convert
+        self.default = default
+
+    @property
+    def uses_ocr_text(self):
+        """
+        True时值来自ocr文本(文字层优先时来自pdf文本，并且有格式校验)；False时只用layout.blocks，ocr只是为图片型pdf提供blocks
+        """
+        return self.relation in ("ocr","pairs")
+
+    def extract(self, layout:PdfLayout, ocr_text=None):
+        """
+        提取这个字段。ocr_text是用ocr_join拼接好的ocr文本，为None时表示文字层优先提取。
+        找不到时返回None(会ocr重试)；锚点找不到时返回anchor_missing，由extract_fields换成default
+        """
+        scan = layout.scan
+        if self.relation == "page_text":
+            return scan.first_matches.get(self.field,anchor_missing)
+        if self.relation == "ocr":
+            return self.extract_ocr(layout,scan,ocr_text)
+        if self.relation == "pairs":
+            return self.extract_pairs(layout,scan,ocr_text)
+        anchor_blocks = [scan.anchors[name] for name in self.anchors]
+        if not all(anchor_blocks):
+            run_log.note(layout.pdf_path,self.field,"找不到锚点:"+",".join(name for name, found in zip(self.anchors,anchor_blocks) if not found))
+            return anchor_missing
+        if self.relation == "same_row":
+            return self.extract_same_row(layout,anchor_blocks[0])
+        if self.relation == "right_of_between":
+            y0 = layout.blocks[anchor_blocks[0][-1]][4]  # 上一个锚点的下边
+            y1 = layout.blocks[anchor_blocks[1][-1]][2]  # 下一个锚点的上边
+            x0 = layout.blocks[anchor_blocks[2][-1]][3]  # 左边锚点的右边
+            return "".join(layout.texts[i].replace("\n","") for i in layout.spatial_index.rect(x0=x0,y0=y0,y1=y1))
+        raise ValueError(f"unknown relation:{self.relation}")
+
+    def extract_ocr(self, layout:PdfLayout, scan, ocr_text):
+        if ocr_text is None:  # 文字层：用"\n"连接各个block，避免发票号码和后面block中的数字连在一起
+            match = self.pattern.search(scan.text)
+            if match is None or (self.text_layer_format is not None and not self.text_layer_format.fullmatch(match.group(1).strip())):
+                return None
+            return match.group(1).strip()
+        match = self.pattern.search(ocr_text)
+        if match is None:
+            run_log.note(layout.pdf_path,self.field,f"can't not find {self.field}")
+            return None
+        res = valid_field(match.group(1).strip(),layout)
+        if res is None:
+            run_log.note(layout.pdf_path,self.field,f"not valid:{match.group(1).strip()}")
+        return res
+
+    def extract_pairs(self, layout:PdfLayout, scan, ocr_text):
+        name_pattern, id_pattern = self.pattern
+        text = scan.text if ocr_text is None else ocr_text
+        name_search = name_pattern.findall(text)
+        id_search = id_pattern.findall(text)
+        if len(name_search) != 2 or len(id_search) != 2:
+            if ocr_text is not None:
+                run_log.note(layout.pdf_path,self.field,f"name_search:{name_search} text_id_search:{id_search}")
+            return None
+        field_res = [name_search[0].strip(),id_search[0].strip(),name_search[1].strip(),id_search[1].strip()]
+        if ocr_text is None:  # 文字层的值要满足基本格式：名称里不能有标签文字，识别号是15~20位数字或大写字母
+            names_ok = all(n.find("识别号") == -1 and n.find("名称") == -1 for n in field_res[0::2])
+            ids_ok = all(self.text_layer_format.fullmatch(t) for t in field_res[1::2])
+            return valid_shun_xu(field_res,layout) if names_ok and ids_ok else None
         for index in range(len(field_res)):
-            res = valid_field(field_res[index],pdf_texts,pdf_path)
+            res = valid_field(field_res[index],layout)
             if res is None:
-                print_error(pdf_path,ocr_texts,pdf_texts,get_ming_cheng_sui_hao.__name__,f"not valid:{field_res[index]}")
+                run_log.note(layout.pdf_path,self.field,f"not valid:{field_res[index]}")
                 return None
-            else:
-                field_res[index] = res
-        return valid_shun_xu(field_res,pdf_path)
-    else:
-        print_error(pdf_path,ocr_texts,pdf_texts,get_ming_cheng_sui_hao.__name__,f"name_search:{name_search} text_id_search:{tax_id_search}")
+            field_res[index] = res
+        return valid_shun_xu(field_res,layout)
+
+    def extract_same_row(self, layout:PdfLayout, anchor_indexes):
+        compact_texts = layout.compact_texts
+        for i in anchor_indexes:  # 值就在锚点这个block里
+            match = self.pattern.search(compact_texts[i])
+            if match:
+                return self.convert(match.group(1))
+        _, _, y0, _, y1 = layout.blocks[anchor_indexes[-1]]
+        row_text = "".join(compact_texts[i] for i in layout.spatial_index.row_band(y0,y1))  # y范围和锚点的y范围有重合的blocks
+        values = self.pattern.findall(row_text)
+        if len(values) == 1:  # 只找到一个，肯定就是要找的值
+            return self.convert(values[0])
+        run_log.note(layout.pdf_path,self.field,f"there are {len(values)} {self.anchors[0]} {values}")  # 找到多个，程序无法识别
         return None
-    
-def get_fa_piao_lei_xing(ocr_texts,pdf_texts:List[str],pdf_path):
-    """
-    提取发票类型，直接从pdf_texts中找，不需要ocr
-    """
-    for text in pdf_texts:
-            invoice_type_search = re.search(r'(增值税专用发票|普通发票)', text)
-            invoice_type = invoice_type_search.group(1) if invoice_type_search else None
-            if invoice_type is not None:
-                return invoice_type
-    return "未识别发票类型"
-def get_he_ji_jin_e2(ocr_texts,pdf_texts:List[str],pdf_path):
-    """
-    提取合计金额，这个方案是直接在pdf_texts中查找。
-    get_text("blocks", sort=True) 不仅返回了文本的内容，还返回了文本的坐标。
-    合计金额一般在价税合计这一文本的同一行。
-    首先找到价税合计的位置的y坐标(y0,y1)。(y0,y1)表示价税合计的y轴坐标范围，y1减去y0是价税合计这一行的高度
-    然后,找y坐标与[y0,y1]有重合的文本。在这些文本中找到￥，它后面的数字就是金额
-    有时候，金额可能就在价税合计这一文本里，这在下面关键点1处处理。
-    如果找到多个金额，程序无法识别。会返回None
-    如果这个范围内只有一个金额，就返回这个金额
-    """
-    doc = fitz.open(pdf_path)
-    page  = doc[-1]
-    blocks = page.get_text("blocks", sort=True)
-    my_blocks = []
-    jia_sui_he_ji_y0= 0  #价税合计的位置
-    jia_sui_he_ji_y1 = 0 #价税合计的位置
-    for block in blocks:
-        x0, y0, x1, y1, text, block_no, block_type = block
-        text:str
-        text = text.strip()
-        text = re.sub(r'\s+', '', text)
-        if(text.find("价税合计")!=-1):
-            jin_e_search = re.search(r'[¥￥]+([\d,]+\.\d{2})',text)
-            if jin_e_search:     # 关键点1：如果价税合计这一行就是金额
-                return float(jin_e_search.group(1).replace(",",""))
-            jia_sui_he_ji_y0 = y0
-            jia_sui_he_ji_y1 = y1
-        my_blocks.append((text,x0,y0,x1,y1))  # 关键点2：这里保存了每个文本的内容以及坐标
-    if jia_sui_he_ji_y0 == 0 or jia_sui_he_ji_y1 == 0:
-        print(f"~~~~~~~~get_he_ji_jin_e2_error:{pdf_path}~~~~~~~~~~~~")
-        print(f"x0,y0,y1 = {jia_sui_he_ji_y0} {jia_sui_he_ji_y1}")
-        for b in my_blocks:
-            print(b)
-        print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-        return ""
-    c_text = ""
-    for b in my_blocks:
-        if (b[2] > jia_sui_he_ji_y0 and b[2] < jia_sui_he_ji_y1) or (
-            b[4] > jia_sui_he_ji_y0 and b[4] < jia_sui_he_ji_y1) or (
-            b[2] < jia_sui_he_ji_y0 and b[4] > jia_sui_he_ji_y1):   # 某个区域的y坐标在价税合计的y坐标范围内
-            c_text += b[0]
-    jin_e_search = re.findall(r'[¥￥]+([\d,]+\.\d{2})',c_text)
-    if len(jin_e_search) == 1:  #如果只找到一个，肯定就是价税合计
-        return float(jin_e_search[0].replace(",",""))
-    else:   # 找到多个，程序无法识别
-        error_file.write(f"{pdf_path} there are {len(jin_e_search)} 价税合计 {jin_e_search}\n")
+
+def parse_amount(s:str):
+    return float(s.replace(",",""))
+
+field_specs = {spec.field:spec for spec in [
+    FieldSpec("发票类型","page_text",r'(增值税专用发票|普通发票)',default="未识别发票类型"),
+    FieldSpec("发票号码","ocr",r'发票号码[:：]?\s*(\d+)',text_layer_format=r'\d{8}|\d{20}'),
+    FieldSpec("名称税号","pairs",(r'名\s*称[:：]+\s*(\S+)',r'识别号[:：]?\s*(\S+)'),ocr_join="\n",text_layer_format=r'[0-9A-Z]{15,20}'),
+    # 合计金额一般在价税合计这一文本的同一行，有时候就在价税合计这个block里。锚点找不到时和以前一样返回""(不再重试)
+    FieldSpec("合计金额","same_row",r'[¥￥]+([\d,]+\.\d{2})',anchors=("价税合计",),convert=parse_amount,default=""),
+    # 备注的文本在价税合计和开票人之间，在"备注"这个文本的右边
+    FieldSpec("备注","right_of_between",anchors=("价税合计","开票人","备注"),default=""),
+]}   # 字段名:提取规则，res_dict中的字段和提取顺序都以这里为准
+he_tong_bian_hao_pattern = re.compile(r'合同编号[:：]?\s*B\s*S\s*([A-Za-z0-9]+)')  # 从备注中提取合同编号，见InvoiceRecord
+
+class PageScan(object):
+    """
+    一次遍历layout.blocks得到的、所有字段共用的信息。blocks不变时只算一次(见PdfLayout.scan)
+    anchors: {锚点名:[block下标,...]}，见anchor_texts
+    first_matches: {字段:值}，relation为"page_text"的字段第一个匹配的值
+    formatted_texts: 每个block格式化(format_str)后的文本，valid_field用
+    text: 所有block的文本用"\n"连接，文字层优先时在这里找发票号码、名称税号
+    """
+    def __init__(self, layout:PdfLayout):
+        self.anchors = {name:[] for name in anchor_texts}
+        self.first_matches = {}
+        self.formatted_texts = []
+        page_text_specs = [spec for spec in field_specs.values() if spec.relation == "page_text"]
+        for i, (text, compact_text) in enumerate(zip(layout.texts,layout.compact_texts)):
+            for name, anchor in anchor_texts.items():
+                if (compact_text in anchor) if isinstance(anchor,tuple) else (compact_text.find(anchor) != -1):
+                    self.anchors[name].append(i)
+            for spec in page_text_specs:
+                if spec.field not in self.first_matches:
+                    match = spec.pattern.search(text)
+                    if match:
+                        self.first_matches[spec.field] = match.group(1)
+            self.formatted_texts.append(format_str(text))
+        self.text = "\n".join(layout.texts)
+
+def extract_fields(fields,ocr_texts,layout:PdfLayout):
+    """
+    按field_specs提取fields中的字段，所有字段共用一次PageScan，ocr文本也只拼接一次。
+    ocr_texts为None时是文字层优先提取(见get_fields_from_text_layer)
+    返回({字段:值},{字段:valid_field核对时的最低相似度},找不到锚点、值是default的字段的集合)，没有核对过的字段相似度为1
+    """
+    with metrics.stage("page_scan"):
+        layout.scan  # 第一次用到时遍历一次blocks
+    ocr_joined = {}
+    res = {}
+    scores = {}
+    defaulted = set()
+    for field in fields:
+        spec = field_specs[field]
+        ocr_text = None
+        if ocr_texts is not None and spec.uses_ocr_text:
+            if spec.ocr_join not in ocr_joined:
+                ocr_joined[spec.ocr_join] = spec.ocr_join.join(ocr_texts)
+            ocr_text = ocr_joined[spec.ocr_join]
+        scores_start = len(layout.match_scores)
+        with metrics.stage(f"extract:{field}"):
+            res[field] = spec.extract(layout,ocr_text)
+        if res[field] is anchor_missing:
+            res[field] = spec.default
+            defaulted.add(field)
+        scores[field] = min(layout.match_scores[scores_start:],default=1.0)
+    return res, scores, defaulted
+
+def ocr_layout_lines(layout:PdfLayout,retry_time:int):
+    """
+    用ocr_retry_ladder中第retry_time次(从1开始)的渲染参数ocr发票页，返回识别出的行(OCR.OcrLine，带页面坐标)
+    """
+    params = ocr_retry_ladder[(retry_time-1) % len(ocr_retry_ladder)]
+    clip = None
+    if params["clip_top"] is not None:
+        rect = layout.page.rect
+        clip = fitz.Rect(rect.x0, rect.y0, rect.x1, rect.y0 + rect.height*params["clip_top"])
+    return OCR.ocr_pdf_page_lines(layout.doc,[layout.page_number],dpi=params["dpi"],colorspace=params["colorspace"],clip=clip)[0]
+
+def ocr_layouts_lines(layouts:List[PdfLayout],retry_time:int):
+    """
+    一批ocr：layouts是同一个pdf中的多页发票，用第retry_time次的渲染参数渲染所有页后一次交给ocr后端(OCR.ocr_pdf_page_lines，微信ocr会把多页拼成一张图识别)，返回每一页识别出的行
+    只渲染页面顶部时，每页的裁剪区域不同，逐页ocr
+    """
+    params = ocr_retry_ladder[(retry_time-1) % len(ocr_retry_ladder)]
+    if params["clip_top"] is not None:
+        return [ocr_layout_lines(layout,retry_time) for layout in layouts]
+    return OCR.ocr_pdf_page_lines(layouts[0].doc,[layout.page_number for layout in layouts],dpi=params["dpi"],colorspace=params["colorspace"])
+
+def classify_pdf(layout:PdfLayout):
+    """
+    根据发票页(默认最后一页)文字层的字数和图片覆盖的面积比例，把pdf分成3类：
+    "text": 文字型(普通电子发票)，先用文字层提取，提取不到的字段再ocr
+    "scanned": 图片型(扫描件)，文字层的字数少于text_min_chars。只用ocr提取，坐标用ocr识别出的行的坐标
+    "mixed": 混合型，有文字层，但图片覆盖了至少image_min_coverage的页面。ocr的行会补充到文字层的blocks中
+    只看文字层字数和图片的位置，不需要渲染页面，很快
+    """
+    if sum(len(text) for text in layout.compact_texts) < text_min_chars:
+        return "scanned"
+    page_rect = layout.page.rect
+    if not layout.page.get_images() or page_rect.is_empty:  # 没有图片时不用计算覆盖面积
+        return "text"
+    image_area = 0
+    for image_info in layout.page.get_image_info():
+        image_area += abs(fitz.Rect(image_info["bbox"]) & page_rect)
+    return "mixed" if image_area / abs(page_rect) >= image_min_coverage else "text"
+
+def is_invoice_page(layout:PdfLayout):
+    """
+    多发票模式(--split_pages)下判断一页是不是发票页：文字层中同时有"发票号码"和"价税合计"这两个锚点。
+    商品清单、说明等其他页没有这两个锚点，跳过。
+    扫描件和大部分是图片的页(见classify_pdf)看不到锚点，先当作发票页，ocr后再看ocr的文本中有没有锚点(见extract_pdf_info)
+    """
+    if layout.scan.anchors["发票号码"] and layout.scan.anchors["价税合计"]:
+        return True
+    return classify_pdf(layout) != "text"
+
+def get_fields_from_text_layer(layout:PdfLayout):
+    """
+    文字层优先提取。电子发票大多是文字型pdf，这时候不需要ocr：
+    只用blocks的字段(发票类型、合计金额、备注)本来就只用pdf文字层；
+    发票号码、名称税号则用同样的正则直接在pdf文本里找(见FieldSpec.extract_ocr)，
+    找到的值要满足基本格式(text_layer_format，发票号码是8位(增值税发票)或20位(全电发票)数字，税号是15~20位数字或大写字母)才采用，否则置为None，交给后面的ocr处理。
+    返回 ({字段:值},找不到锚点、值是default的字段的集合)，找不到的字段值为None
+    """
+    res, _, defaulted = extract_fields(field_specs,None,layout)
+    return res, defaulted
+
+csv_field_name = ['PDF绝对路径',
+    '发票类型',
+    '发票号码',
+    '发票号码简写',
+    '购买方名称',
+    '购买方纳税人识别号',
+    '销售方名称',
+    '销售方纳税人识别号',
+    '价税合计金额',
+    '备注',
+    '合同编号',
+    '页码'
+]
+progress_file_name = "progress.jsonl"  # 进度文件，每处理完一个pdf记录一行，--resume时用来跳过已经处理过的pdf
+metrics_file_name = "metrics.jsonl"  # 每张发票各阶段的耗时，每处理完一个pdf记录一行
+metrics_summary_file_name = "metrics_summary.json"  # 本次运行结束时对metrics.jsonl的汇总
+duplicates_file_name = "duplicates.csv"  # 重复的发票，以及第一次出现时的pdf
+duplicates_field_name = ['PDF绝对路径','发票号码','销售方纳税人识别号','价税合计金额','原发票PDF','原发票第一次出现时间']
+
+class InvoiceRecord(object):
+    """
+    一张发票的提取结果，属性和csv的列一一对应(顺序也一样，见csv_field_name)，提取不到的字段(包括空字符串)为None。
+    发票号码简写(发票号码的后8位)和合同编号(从备注中的"合同编号：BSxxxx"提取)在创建时就算好，不用再解析res_dict
+    """
+    __slots__ = ("pdf_path","fa_piao_lei_xing","fa_piao_hao_ma","fa_piao_hao_ma_jian_xie",
+                 "gou_mai_fang_ming_cheng","gou_mai_fang_shui_hao","xiao_shou_fang_ming_cheng","xiao_shou_fang_shui_hao",
+                 "he_ji_jin_e","bei_zhu","he_tong_bian_hao","ye_ma","ocr_cheng_gong_ci_shu","zhi_xin_du")
+
+    def __init__(self, res_dict):
+        """
+        res_dict是extract_pdf_info的结果
+        """
+        self.pdf_path = res_dict["PDF绝对路径"]
+        self.fa_piao_lei_xing = res_dict["发票类型"]
+        self.fa_piao_hao_ma = res_dict["发票号码"]
+        self.fa_piao_hao_ma_jian_xie = res_dict["发票号码"][-8:] if res_dict["发票号码"] is not None else None
+        ming_cheng_shui_hao = res_dict["名称税号"] if res_dict["名称税号"] is not None else [None]*4
+        self.gou_mai_fang_ming_cheng, self.gou_mai_fang_shui_hao, self.xiao_shou_fang_ming_cheng, self.xiao_shou_fang_shui_hao = ming_cheng_shui_hao
+        self.he_ji_jin_e = res_dict["合计金额"]
+        self.bei_zhu = res_dict["备注"].strip() if res_dict["备注"] is not None else None
+        self.he_tong_bian_hao = None
+        if self.bei_zhu is not None:
+            contract_number_search = he_tong_bian_hao_pattern.search(self.bei_zhu)
+            if contract_number_search:
+                self.he_tong_bian_hao = contract_number_search.group(1)
+        self.ye_ma = res_dict.get("页码")  # 发票在pdf中的第几页(从1开始)
+        self.ocr_cheng_gong_ci_shu = res_dict.get("OCR成功次数")  # 第几次ocr后所有字段都提取到了，0表示没有用ocr，None表示没有提取全
+        self.zhi_xin_du = res_dict.get("置信度")  # {字段:置信度(0~1)}，见extract_pdf_info
+        for name in self.__slots__:  # 找不到锚点时合计金额、备注等是空字符串，统一成None
+            if getattr(self,name) == "":
+                setattr(self,name,None)
+
+    def to_row(self):
+        """
+        csv的一行，None写成空字符串
+        """
+        values = [getattr(self,name) for name in self.__slots__[:len(csv_field_name)]]
+        return [value if value is not None else "" for value in values]
+
+    def to_dict(self):
+        """
+        {csv表头:值}
+        """
+        return dict(zip(csv_field_name,self.to_row()))
+
+    def __repr__(self):
+        return f"InvoiceRecord({self.to_dict()})"
+
+def pdf_info_to_row(pdf_info):
+    """
+    把一个pdf的识别信息转换成csv的一行
+    """
+    return InvoiceRecord(pdf_info).to_row()
+
+def extract_invoice(pdf, name:str="<memory>", use_result_cache:bool=False, split_pages:bool=False):
+    """
+    给其他程序调用的接口：从内存中的pdf提取发票信息，不需要先把pdf写成文件。
+    pdf: pdf的bytes(或bytearray、memoryview)，也可以是有read方法的文件对象(比如io.BytesIO、上传的附件)
+    name: 只用于日志和结果中的pdf_path
+    use_result_cache: 默认不读写cache文件夹；也不查发票索引(见extract_pdf_info的check_duplicates)。
+    除了ocr：需要ocr时，微信ocr后端(默认)把渲染的页面写成临时png文件交给wcocr，识别完删除
+    split_pages: True时pdf中每一页发票都提取，返回InvoiceRecord的列表(按页码顺序)
+    返回InvoiceRecord。日志用logging输出到"fa_piao"这个logger，调用者可以自己配置
+    当前发票的耗时(metrics)和失败记录(run_log)放在模块的全局变量中，不能在多个线程中同时调用：多线程的服务要加锁，或者用多进程
+    """
+    if hasattr(pdf,"read"):
+        pdf = pdf.read()
+    pdf_info = extract_pdf_info(name,bytes(pdf),use_result_cache,split_pages)
+    if split_pages:
+        return [InvoiceRecord(res_dict) for res_dict in pdf_info]
+    return InvoiceRecord(pdf_info)
+
+def get_progress_key(pdf_path):
+    """
+    进度文件中标识一个pdf的key：(绝对路径,修改时间,文件大小)。pdf被修改过的话key会变，--resume时会重新处理
+    """
+    stat = os.stat(pdf_path)
+    return (os.path.abspath(pdf_path), stat.st_mtime_ns, stat.st_size)
+
+def load_progress():
+    """
+    读取本次输出文件夹中的进度文件，返回已经处理完的pdf的key的集合。
+    处理失败的pdf不算处理完(可能是ocr引擎启动失败、内存不够、文件被占用等临时的错误)，--resume时重新处理；只有打不开的pdf(文件损坏)会跳过
+    """
+    done_keys = set()
+    progress_path = os.path.join(this_time_output_folder,progress_file_name)
+    if not os.path.exists(progress_path):
+        return done_keys
+    with open(progress_path,"r",encoding="utf8") as file:
+        for line in file:
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:  # 上次运行在写这一行时被中断了
+                continue
+            if item.get("failed") and not item.get("corrupt"):
+                continue
+            done_keys.add((item["path"],item["mtime_ns"],item["size"]))
+    return done_keys
+
+def pdf_infos_to_csv(pdf_infos,csv_file_name="fa_piao_info.csv",jsonl_file_name=None):
+    """
+    把识别到的信息写入csv文件，output_formats中有sqlite时同时写入sqlite(见get_sqlite_sink，批量写入，出错中断时也会把攒着的行写入)。
+    pdf_infos可以是列表，也可以是生成器，每一项是一个pdf的res_dict(多发票模式下是res_dict列表)：每拿到一个pdf的信息就马上写入csv，各阶段耗时写入metrics.jsonl，并在进度文件中记录这个pdf已经处理完，
+    这样运行中断时已经处理的结果不会丢失，也不需要把所有结果放在内存中。
+    进度在这个pdf的行写进csv、并且sqlite中包含它的那一批提交之后才记录(见SqliteSink.after_written)，进程被杀掉时也不会有记录了进度、却没写入的pdf。
+    csv文件已经存在时(--resume)接着写，不再写表头；已经在csv中、但还没记录进度的行(上次在写入和记录进度之间中断了)不再重复写。
+    jsonl_file_name不为None时，每一行同时以json(表头:值)写到这个文件中，方便其他程序读取
+    写入前用发票索引检查是不是重复的发票(见check_duplicate)，重复的发票记录在duplicates.csv中，duplicates_mode为skip时不写入csv
+    处理失败的pdf(见process_pdf_safely)不写入csv，在进度文件中记录为failed，--resume时重新处理；pdf文件损坏时还记录为corrupt，--resume时不会再处理(修复或替换pdf后，修改时间变了会重新处理)
+    """
+    csv_path = os.path.join(this_time_output_folder,csv_file_name)
+    jsonl_file = open(os.path.join(this_time_output_folder,jsonl_file_name),"a",encoding="utf8") if jsonl_file_name is not None else None
+    duplicates_file = None  # 第一次发现重复时才创建
+    write_header = not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0
+    write_csv = "csv" in output_formats
+    sink = get_sqlite_sink()
+    with (open(csv_path,"a",encoding="utf8",newline="") if write_csv else contextlib.nullcontext()) as file, open(os.path.join(this_time_output_folder,progress_file_name),"a",encoding="utf8") as progress_file, open(os.path.join(this_time_output_folder,metrics_file_name),"a",encoding="utf8") as metrics_file:
+        writer = csv.writer(file) if write_csv else None
+        if write_csv and write_header:
+            writer.writerow(csv_field_name)
+            file.flush()
+        written_rows = set()  # csv中已有的(PDF绝对路径,页码)
+        if write_csv and not write_header:
+            with open(csv_path,"r",encoding="utf8",newline="") as old_file:
+                written_rows = {(old_row[0],old_row[-1]) for old_row in csv.reader(old_file) if old_row and old_row != csv_field_name}
+
+        def write_progress(progress):
+            progress_file.write(json.dumps(progress,ensure_ascii=False)+"\n")
+            progress_file.flush()
+
+        try:
+            for pdf_result in pdf_infos:
+                failed = is_failed(pdf_result)
+                for pdf_info in ([] if failed else pdf_result if isinstance(pdf_result,list) else [pdf_result]):  # 多发票模式下一个pdf有多张发票
+                    invoice_metrics = pdf_info.pop("metrics",None)
+                    record = InvoiceRecord(pdf_info)
+                    row = record.to_row()
+                    duplicate_of = check_duplicate(pdf_info)
+                    if duplicate_of is not None:
+                        if duplicates_file is None:
+                            duplicates_path = os.path.join(this_time_output_folder,duplicates_file_name)
+                            duplicates_write_header = not os.path.exists(duplicates_path) or os.path.getsize(duplicates_path) == 0
+                            duplicates_file = open(duplicates_path,"a",encoding="utf8",newline="")
+                            duplicates_writer = csv.writer(duplicates_file)
+                            if duplicates_write_header:
+                                duplicates_writer.writerow(duplicates_field_name)
+                        duplicates_writer.writerow([pdf_info["PDF绝对路径"],duplicate_of.fa_piao_hao_ma,duplicate_of.xiao_shou_fang_shui_hao,duplicate_of.he_ji_jin_e,duplicate_of.pdf_path,duplicate_of.first_seen])
+                        duplicates_file.flush()
+                    already_written = (row[0],str(row[-1])) in written_rows
+                    if write_csv and (duplicate_of is None or duplicates_mode != "skip") and not already_written:
+                        writer.writerow(row)
+                    if invoice_metrics is not None:
+                        metrics_file.write(json.dumps(invoice_metrics,ensure_ascii=False)+"\n")
+                        metrics_file.flush()
+                    if jsonl_file is not None and (duplicate_of is None or duplicates_mode != "skip") and not already_written:
+                        jsonl_file.write(json.dumps(dict(zip(csv_field_name,row)),ensure_ascii=False)+"\n")
+                        jsonl_file.flush()
+                    if write_csv:
+                        file.flush()  # 先保证csv写进去了，再记录进度
+                    if sink is not None:
+                        sink.add(record,duplicate_of.pdf_path if duplicate_of is not None else None,pdf_info.get("置信度"))
+                try:  # csv已经写进去了，记录进度
+                    path, mtime_ns, size = get_progress_key((pdf_result[0] if isinstance(pdf_result,list) else pdf_result)["PDF绝对路径"])
+                except OSError:  # 处理完后pdf已经被移走或删除了，不用记录进度
+                    continue
+                progress = {"path":path,"mtime_ns":mtime_ns,"size":size}
+                if failed:
+                    progress["failed"] = True
+                    if pdf_result["文件损坏"]:
+                        progress["corrupt"] = True
+                if sink is not None:  # 等包含这个pdf的行的那一批写入sqlite后再记录
+                    sink.after_written(functools.partial(write_progress,progress))
+                else:
+                    write_progress(progress)
+        finally:  # 出错中断时也要把攒着的行写入sqlite并记录它们的进度。sqlite中按(pdf,页码)去重，--resume重复写入也没关系
+            if sink is not None:
+                sink.flush()
+    if jsonl_file is not None:
+        jsonl_file.close()
+    if duplicates_file is not None:
+        duplicates_file.close()
+
+_sqlite_sink = None
+def get_sqlite_sink():
+    """
+    返回主进程的SqliteSink，第一次调用时打开数据库，并在runs表中记录本次运行。output_formats中没有sqlite时返回None
+    """
+    global _sqlite_sink
+    if "sqlite" not in output_formats:
         return None
+    if _sqlite_sink is None:
+        _sqlite_sink = SqliteSink(sqlite_file,sqlite_batch_size)
+        _sqlite_sink.begin_run(output_folder=os.path.abspath(this_time_output_folder),input_folder=os.path.abspath(input_folder) if input_folder else None,
+                               extract_mode=extract_mode,ocr_backend=ocr_backend,extractor_version=extractor_version)
+    return _sqlite_sink
 
-def get_he_ji_jin_e(ocr_texts,pdf_texts:List[str],pdf_path):
-    """
-    提取合计金额，这个方案是直接在ocr_texts中查找。
-    用ocr的方案有概率会识别不到，弃用，使用get_he_ji_jin_e2
-    """
-    text = "".join(ocr_texts)
-    total_amount_search = re.search(r'[(（)]+小写[)）]+[:：]?\s*[¥￥]+\s*([\d,]+\.\d{2})', text)
-    if total_amount_search:
-        amount_str= total_amount_search.group(1)
-        amount_valid = valid_field(amount_str,pdf_texts,pdf_path)
-        if amount_valid is not None:
-            method2_res = get_he_ji_jin_e2(ocr_texts,pdf_texts,pdf_path)
-            if method2_res is not None:
-                if abs(float(amount_valid.replace(',', '')) - method2_res) > 0.01:
-                    print_error(pdf_path,ocr_texts,pdf_texts,get_he_ji_jin_e.__name__,f"method1:{amount_valid} method2:{method2_res}")
-            else:
-                print(f"method2 is None:{pdf_path}")
-            return float(amount_valid.replace(',', ''))
-        else:
-            print_error(pdf_path,ocr_texts,pdf_texts,get_he_ji_jin_e.__name__,f"not valid:{amount_str}")
-            return None
-    print_error(pdf_path,ocr_texts,pdf_texts,get_he_ji_jin_e.__name__,f"can't not find (小写)")
+def close_sqlite_sink():
+    """
+    运行结束时调用：写入剩下的行，记录结束时间和发票数
+    """
+    global _sqlite_sink
+    if _sqlite_sink is not None:
+        _sqlite_sink.close()
+        _sqlite_sink = None
+
+_invoice_indexes = {}
+def get_invoice_index(readonly=False):
+    """
+    返回本进程的InvoiceIndex，第一次调用时打开。duplicates_mode为off时返回None。
+    readonly=True用于在子进程中查询；数据库还不存在时返回None，并且记住打不开，之后不再每次都尝试打开
+    """
+    if duplicates_mode == "off":
+        return None
+    if readonly not in _invoice_indexes:
+        try:
+            _invoice_indexes[readonly] = InvoiceIndex(invoice_index_file,readonly)
+        except sqlite3.OperationalError:
+            _invoice_indexes[readonly] = None
+    return _invoice_indexes[readonly]
+
+def get_index_key(res_dict):
+    """
+    发票索引的key：(发票号码,销售方纳税人识别号,价税合计金额)，有一个没有提取到时返回None
+    """
+    he_ji_jin_e = res_dict["合计金额"]
+    if res_dict["发票号码"] is None or res_dict["名称税号"] is None or not isinstance(he_ji_jin_e,(int,float)):
+        return None
+    return (res_dict["发票号码"],res_dict["名称税号"][3],he_ji_jin_e)
+
+def check_duplicate(res_dict):
+    """
+    在主进程中写csv前调用：是重复的发票时返回原发票的IndexEntry，否则把这张发票加入索引并返回None
+    """
+    index = get_invoice_index()
+    key = get_index_key(res_dict)
+    if index is None or key is None:
+        return None
+    duplicate_of = index.find_duplicate(*key,res_dict["PDF绝对路径"])
+    if duplicate_of is not None:
+        logger.warning(f"{res_dict['PDF绝对路径']} 和 {duplicate_of.pdf_path} 是同一张发票(发票号码{key[0]})")
+        return duplicate_of
+    index.add(*key,res_dict["PDF绝对路径"],{field:res_dict[field] for field in field_specs})
     return None
 
+def find_duplicate_before_ocr(res_dict):
+    """
+    文字层已经提取到发票号码时，在ocr之前查发票索引：
+    以前处理过的另一个pdf发票号码相同，并且文字层提取到的销售方税号、金额也都相同时，认为是重复的发票，返回原发票的IndexEntry，
+    调用者用原发票的字段补全没有提取到的字段，不用再ocr。
+    文字层只提取到发票号码时，只有20位的全电发票号码(全国唯一)才这样判断
+    """
+    fa_piao_hao_ma = res_dict["发票号码"]
+    index = get_invoice_index(readonly=True)
+    if index is None or fa_piao_hao_ma is None:
+        return None
+    xiao_shou_fang_shui_hao = res_dict["名称税号"][3] if res_dict["名称税号"] is not None else None
+    he_ji_jin_e = format_amount(res_dict["合计金额"]) if isinstance(res_dict["合计金额"],(int,float)) else None
+    if xiao_shou_fang_shui_hao is None and he_ji_jin_e is None and len(fa_piao_hao_ma) < 20:
+        return None
+    for entry in index.lookup(fa_piao_hao_ma):
+        if entry.pdf_path == res_dict["PDF绝对路径"]:
+            continue
+        if xiao_shou_fang_shui_hao is not None and entry.xiao_shou_fang_shui_hao != xiao_shou_fang_shui_hao:
+            continue
+        if he_ji_jin_e is not None and entry.he_ji_jin_e != he_ji_jin_e:
+            continue
+        return entry
+    return None
 
-field_func_maps = {
-    "发票类型":get_fa_piao_lei_xing,
-    "发票号码":get_fa_piao_hao_ma,
-    "名称税号":get_ming_cheng_sui_hao,
-    "合计金额":get_he_ji_jin_e2,
-    "备注":get_bei_zhu,
-}   # 这个用来存放各个信息的提取函数,比如发票类型的提取函数是get_fa_piao_lei_xing，即发票类型用get_fa_piao_lei_xing函数提取
-
-def pdf_infos_to_csv(pdf_infos):
-    """
-    把识别到的信息写入csv文件
-    """
-    csv_field_name = ['PDF绝对路径',
-        '发票类型',
-        '发票号码',
-        '发票号码简写',
-        '购买方名称',
-        '购买方纳税人识别号',
-        '销售方名称',
-        '销售方纳税人识别号',
-        '价税合计金额',
-        '备注',
-        '合同编号'
-    ]
-    
-    with open(os.path.join(this_time_output_folder,"fa_piao_info.csv"),"w",encoding="utf8",newline="") as file:
-        writer =csv.writer(file)
-        writer.writerow(csv_field_name)
-
-        for pdf_info in pdf_infos:
-            row_data= []
-            row_data.append(pdf_info["PDF绝对路径"] if pdf_info["PDF绝对路径"] is not None else "")
-            row_data.append(pdf_info["发票类型"] if pdf_info["发票类型"] is not None else "")
-            row_data.append(pdf_info["发票号码"] if pdf_info["发票号码"] is not None else "")
-            row_data.append(pdf_info["发票号码"][-8:] if pdf_info["发票号码"] is not None else "")
-            row_data.append(pdf_info["名称税号"][0] if pdf_info["名称税号"] is not None else "")
-            row_data.append(pdf_info["名称税号"][1] if pdf_info["名称税号"] is not None else "")
-            row_data.append(pdf_info["名称税号"][2] if pdf_info["名称税号"] is not None else "")
-            row_data.append(pdf_info["名称税号"][3] if pdf_info["名称税号"] is not None else "")
-            row_data.append(pdf_info["合计金额"] if pdf_info["合计金额"] is not None else "")
-            bei_zhu = pdf_info["备注"] if pdf_info["备注"] is not None else ""
-            bei_zhu = bei_zhu.strip()
-            row_data.append(bei_zhu)
-            
-            contract_number_search = re.search(r'合同编号[:：]?\s*B\s*S\s*([A-Za-z0-9]+)', bei_zhu)
-            if contract_number_search:
-                contract_number = contract_number_search.group(1)
+
+def process_pdf(pdf_path):
+    """
+    提取一个PDF文件的发票信息，返回res_dict；split_pages为True时返回res_dict列表，每张发票一个(见extract_pdf_info)。
+    res_dict["metrics"]是这个pdf各阶段的耗时(见metrics.py)，写csv时会单独写到metrics.jsonl中。多发票时只放在第一个res_dict中
+    """
+    metrics.begin(os.path.abspath(pdf_path))
+    res = extract_pdf_info(pdf_path,split_pages=split_pages,check_duplicates=True)
+    (res[0] if isinstance(res,list) else res)["metrics"] = metrics.end()
+    return res
+
+def extract_pdf_info(pdf_path,pdf_bytes=None,use_result_cache=True,split_pages=False,check_duplicates=False):
+    """
+    提取一个PDF文件的发票信息，返回res_dict
+    pdf_bytes不为None时直接用内存中的pdf，pdf_path只用于日志和结果(见extract_invoice)
+    use_result_cache为False时不读写缓存
+    split_pages为True时(多发票模式)，pdf中每一张发票页(见is_invoice_page)都单独提取，返回res_dict列表(按页码顺序)：
+    需要ocr的页在一批中渲染和ocr(见extract_layouts)；
+    连续几页发票号码相同时(一张发票有多页)只保留最后一页；一张发票页也没找到时，和以前一样提取最后一页
+    check_duplicates为True时在ocr之前查发票索引(见find_duplicate_before_ocr)，只有批量处理和长期运行的模式(process_pdf)才查，
+    extract_invoice不查，不会打开outputs中的索引文件
+    """
+    logger.info(f"===========正在处理PDF文件：{pdf_path}")
+    if pdf_bytes is None:
+        with open(pdf_path,"rb") as file:
+            pdf_bytes = file.read()
+        pdf_path_in_result = os.path.abspath(pdf_path)
+    else:
+        pdf_path_in_result = pdf_path
+    cache = get_result_cache() if use_result_cache else None
+    if cache is not None:
+        with metrics.stage("cache_lookup"):
+            cache_key = cache.make_key(pdf_bytes,ocr_backend,extract_mode,"split_pages" if split_pages else "last_page")  # 不同后端、模式的结果不一样，分开缓存
+            cache_entry = cache.get(cache_key)
+        if cache_entry is not None:  # 同样内容的pdf以前提取过，直接用缓存的结果
+            logger.info(f"{pdf_path} 使用缓存的结果")
+            metrics.count("cache_hit")
+            res = cache_entry["res_dict"]
+            for res_dict in (res if split_pages else [res]):
+                res_dict["PDF绝对路径"] = pdf_path_in_result  # 同样内容的pdf可能换了文件名
+            return res
+    run_log.begin_invoice()  # 之后的提取失败都记在这个pdf上
+    if split_pages:
+        with metrics.stage("pdf_open"):
+            doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        layouts = [PdfLayout(pdf_path,page_number=page_number,doc=doc) for page_number in range(len(doc))]
+        invoice_layouts = [layout for layout in layouts if is_invoice_page(layout)] or layouts[-1:]
+        metrics.count("invoice_pages",len(invoice_layouts))
+    else:
+        doc = None
+        invoice_layouts = [PdfLayout(pdf_path,pdf_bytes)]  # PDF只打开和解析一次，后面的OCR和所有提取函数共用
+    items = extract_layouts(invoice_layouts,pdf_path_in_result,split_pages,check_duplicates)
+    if split_pages:
+        kept = []
+        for item in items:
+            anchors_found = item["layout"].scan.anchors["发票号码"] or item["layout"].scan.anchors["价税合计"]
+            if item["pdf_kind"] != "text" and not anchors_found:  # ocr后也没有锚点，不是发票页
+                logger.info(f"{pdf_path} 第{item['layout'].page_number+1}页不是发票，跳过")
+                continue
+            if kept and item["res_dict"]["发票号码"] is not None and kept[-1]["res_dict"]["发票号码"] == item["res_dict"]["发票号码"]:
+                kept.pop()  # 同一张发票的多页，保留最后一页(价税合计在最后一页)
+            kept.append(item)
+        items = kept or items[-1:]
+    # 有提取失败时，把这个pdf的文本、blocks和最后一次ocr文本写一次到diagnostics.jsonl.gz
+    if len(items) == 1:
+        item = items[0]
+        run_log.end_invoice(pdf_path_in_result,pdf_kind=item["pdf_kind"],texts=item["layout"].texts,blocks=item["layout"].blocks,ocr_texts=item["last_ocr_texts"])
+    else:
+        run_log.end_invoice(pdf_path_in_result,pages=[{"page":item["layout"].page_number+1,"pdf_kind":item["pdf_kind"],"texts":item["layout"].texts,
+                                                      "blocks":item["layout"].blocks,"ocr_texts":item["last_ocr_texts"]} for item in items])
+    for layout in invoice_layouts:
+        layout.close()
+    if doc is not None:
+        doc.close()
+    res = [item["res_dict"] for item in items] if split_pages else items[0]["res_dict"]
+    if cache is not None and all(item["res_dict"]["OCR成功次数"] is not None for item in items):  # 有字段没提取到时不缓存，下次运行还会重试
+        with metrics.stage("cache_put"):
+            cache.put(cache_key,res,[item["last_ocr_texts"] for item in items] if split_pages else items[0]["last_ocr_texts"])
+    return res
+
+def extract_layouts(layouts:List[PdfLayout],pdf_path_in_result:str,split_pages:bool=False,check_duplicates:bool=False):
+    """
+    提取layouts(同一个pdf中的一张或多张发票页)的信息。
+    每一页先分类、用文字层提取、查重复(check_duplicates为True时)，然后所有还有字段没提取到的页一起ocr(ocr_layouts_lines)，每次重试换一组渲染参数，
+    直到所有页都提取全、或重试次数用完、或这一页的ocr结果和上一次相同。
+    多发票模式(split_pages)下，扫描页第一次ocr后还没有发票号码、价税合计锚点的，不是发票页，不再重试("not_invoice"为True)。
+    返回每一页的{"layout":..., "pdf_kind":..., "res_dict":..., "last_ocr_texts":...}
+    """
+    items = []
+    for layout in layouts:
+        where = f"{layout.pdf_path} 第{layout.page_number+1}页" if split_pages else layout.pdf_path
+        with metrics.stage("classify"):
+            pdf_kind = classify_pdf(layout)  # text / scanned / mixed
+        metrics.count(f"pdf_{pdf_kind}")
+        if pdf_kind != "text":
+            logger.info(f"{where}是{'图片型' if pdf_kind == 'scanned' else '混合型'}pdf,用ocr识别出的行和坐标提取")
+        res_dict = {t:None for t in field_specs}  # 提取到的信息将放在res_dict中
+        res_dict["PDF绝对路径"] = pdf_path_in_result
+        res_dict["页码"] = layout.page_number + 1
+        confidence = {}  # 每个字段的置信度：文字层直接提取到的为1；ocr后提取到的为在文字层中核对时的相似度；图片型、混合型pdf为ocr_only_confidence
+        if extract_mode == "text_first" and pdf_kind != "scanned":  # 图片型pdf没有文字层，直接ocr
+            with metrics.stage("text_layer"):
+                text_layer_res, defaulted = get_fields_from_text_layer(layout)  # 文字层能提取到的字段就不用ocr了
+            if pdf_kind == "mixed":  # 混合型pdf只采用有格式校验的字段，只用坐标的字段等ocr的行加入blocks后再提取
+                text_layer_res = {field:text_layer_res[field] for field in ["发票号码","名称税号"]}
+                defaulted = set()
+            res_dict.update(text_layer_res)
+            confidence.update({field:1.0 for field, value in text_layer_res.items() if value is not None and field not in defaulted})
+            if check_duplicates and any(res_dict[field] is None for field in field_specs):
+                with metrics.stage("duplicate_lookup"):
+                    duplicate_of = find_duplicate_before_ocr(res_dict)
+                if duplicate_of is not None:  # 重复提交的发票，用原发票的结果补全，不用ocr。写csv时会记录到duplicates.csv
+                    logger.info(f"{where} 和 {duplicate_of.pdf_path} 发票号码相同，使用原发票的结果，不再ocr")
+                    metrics.count("duplicate_before_ocr")
+                    for field in field_specs:
+                        if res_dict[field] is None:
+                            res_dict[field] = duplicate_of.fields.get(field)
+                            confidence[field] = duplicate_confidence
+        else:
+            defaulted = set()
+        # defaulted: 找不到锚点、值是default的字段。图片型、混合型pdf的blocks来自ocr，这些字段先保持None，下一次ocr再提取，重试完还找不到才用default
+        items.append({"layout":layout,"pdf_kind":pdf_kind,"where":where,"res_dict":res_dict,"confidence":confidence,"defaulted":defaulted,
+                      "last_ocr_texts":None,"retry_time":0,"stopped":False,"not_invoice":False})
+    retry_time = 0
+    while retry_time < max_retry_time: # 如果有一个字段没有提取到，就ocr重试，最多重试 max_retry_time 次
+        todo = [item for item in items if not item["stopped"] and any(item["res_dict"][field] is None for field in field_specs)]
+        if not todo:
+            break
+        retry_time += 1
+        if ocr_retry_ladder[(retry_time-1) % len(ocr_retry_ladder)]["clip_top"] is not None:  # 合计金额、备注等不在页面顶部，只ocr顶部提取不到
+            todo = [item for item in todo if all(field in clip_top_fields for field in field_specs if item["res_dict"][field] is None)]
+            if not todo:
+                continue
+        metrics.count("ocr_attempts",len(todo))
+        if retry_time > 1:
+            metrics.count("ocr_retries",len(todo))
+        page_lines = ocr_layouts_lines([item["layout"] for item in todo],retry_time) # ocr, 只渲染和识别发票页，所有页一批完成，每次重试换一组渲染参数
+        for item, ocr_lines in zip(todo,page_lines):
+            layout, res_dict, confidence = item["layout"], item["res_dict"], item["confidence"]
+            ocr_texts = [line.text for line in ocr_lines]
+            if ocr_texts == item["last_ocr_texts"]:  # 和上一次ocr结果一样，再提取一次也不会有新结果，不再重试
+                logger.info(f"{item['where']} 第{retry_time}次ocr结果与上一次相同，停止重试")
+                metrics.count("ocr_same_as_last")
+                item["stopped"] = True
+                continue
+            first_ocr = item["last_ocr_texts"] is None
+            item["last_ocr_texts"] = ocr_texts
+            item["retry_time"] = retry_time
+            if item["pdf_kind"] != "text":  # 提取函数用的坐标改为ocr识别出的行的坐标
+                layout.use_ocr_lines(ocr_lines,keep_text_layer=(item["pdf_kind"] == "mixed"))
+                if split_pages and first_ocr and not (layout.scan.anchors["发票号码"] or layout.scan.anchors["价税合计"]):
+                    # 多发票模式下，第一次ocr后还是没有锚点的扫描页是商品清单、封面等，不是发票页，不再重试(extract_pdf_info会跳过这一页)
+                    metrics.count("not_invoice_after_ocr")
+                    item["stopped"] = item["not_invoice"] = True
+                    continue
+            missing = [field for field in field_specs if res_dict[field] is None]
+            ocr_res, scores, defaulted = extract_fields(missing,ocr_texts,layout)  # 只提取还没提取到的字段，所有字段共用一次PageScan
+            for field, value in ocr_res.items():
+                if field in defaulted:
+                    item["defaulted"].add(field)
+                    if item["pdf_kind"] != "text":  # 可能是这次ocr没识别出锚点，下一次ocr换了渲染参数再提取
+                        value = None
+                else:
+                    item["defaulted"].discard(field)
+                res_dict[field] = value
+                if value is not None:
+                    confidence[field] = scores[field] if item["pdf_kind"] == "text" else ocr_only_confidence
+    for item in items:
+        res_dict = item["res_dict"]
+        for field in item["defaulted"]:  # 重试完还是找不到锚点，和文字型pdf一样用default
+            if res_dict[field] is None:
+                res_dict[field] = field_specs[field].default
+        # 记录第几次ocr后所有字段都提取到了，0表示没有用ocr，None表示重试完也没有提取全(找不到锚点、用了default的字段也算没有提取到)
+        missing = [field for field in field_specs if res_dict[field] is None or field in item["defaulted"]]
+        res_dict["OCR成功次数"] = None if missing else item["retry_time"]
+        res_dict["置信度"] = {field:(item["confidence"].get(field,1.0) if field not in missing else 0.0) for field in field_specs}
+        if res_dict["OCR成功次数"]:
+            logger.info(f"{item['where']} 第{item['retry_time']}次ocr后提取到所有字段")
+        elif res_dict["OCR成功次数"] is None and not item["not_invoice"]:
+            logger.error(f"{item['where']} 没有提取到:{','.join(missing)}")
+    return items
+
+_result_cache = None
+def get_result_cache():
+    """
+    返回本进程的ResultCache，第一次调用时创建。use_cache为False时返回None
+    """
+    global _result_cache
+    if not use_cache:
+        return None
+    if _result_cache is None:
+        _result_cache = ResultCache(cache_folder,extractor_version,cache_max_mb*1024*1024,rebuild_cache)
+    return _result_cache
+
+def get_worker_config():
+    """
+    主进程中通过命令行参数设置的全局变量，需要传给子进程
+    """
+    return {
+        "this_time_output_folder":this_time_output_folder,
+        "extract_mode":extract_mode,
+        "use_cache":use_cache,
+        "rebuild_cache":rebuild_cache,
+        "ocr_backend":ocr_backend,
+        "profile":profile,
+        "log_level":log_level,
+        "log_background":log_background,
+        "duplicates_mode":duplicates_mode,
+        "invoice_index_file":invoice_index_file,
+        "split_pages":split_pages,
+    }
+
+def init_worker(worker_config):
+    """
+    进程池中每个子进程启动时调用。
+    子进程里不会执行 if __name__ == "__main__": 这部分，所以这里用worker_config(见get_worker_config)重新设置全局变量，
+    并且每个子进程有自己的all/warning/error日志文件(放在本次输出文件夹的workers文件夹下)，避免多个进程同时写一个文件。
+    ocr引擎在子进程第一次ocr时各自初始化，之后在这个子进程中复用。
+    """
+    globals().update(worker_config)
+    _invoice_indexes.clear()  # fork方式启动时会继承主进程的sqlite连接，不能在子进程中使用
+    OCR.set_backend(ocr_backend)
+    OCR.stage_timer = metrics.stage
+    worker_log_folder = os.path.join(this_time_output_folder,"workers")
+    os.makedirs(worker_log_folder,exist_ok=True)
+    pid = os.getpid()
+    run_log.discard_inherited_logging()  # fork方式启动时会继承主进程的日志输出，丢掉，避免子进程也写主进程的日志文件
+    run_log.setup_logging(worker_log_folder,f"_{pid}","w",log_level,log_background)
+    # 子进程退出时不会执行atexit，用Finalize把缓冲中的日志写完。exitpriority比dump_profile低，后执行
+    multiprocessing.util.Finalize(None,run_log.shutdown_logging,exitpriority=1)
+    if profile:  # 每个子进程单独统计，子进程退出时写到workers/profile_<pid>.prof
+        profiler = cProfile.Profile()
+        profiler.enable()
+        def dump_profile():
+            profiler.disable()
+            profiler.dump_stats(os.path.join(worker_log_folder,f"profile_{pid}.prof"))
+        multiprocessing.util.Finalize(None,dump_profile,exitpriority=10)
+
+def process_pdf_safely(pdf_path):
+    """
+    和process_pdf一样，但出错时(文件不存在、还没复制完、不是pdf、ocr出错等)只记录错误日志，返回{"PDF绝对路径":...,"处理失败":错误信息,"文件损坏":是不是pdf打不开}，
+    一个pdf出错不会中断整个运行。写csv时不写这个pdf，只在进度文件中记录它处理失败了(见pdf_infos_to_csv)
+    """
+    try:
+        return process_pdf(pdf_path)
+    except Exception as e:
+        metrics.end()
+        logger.exception(f"{pdf_path} 处理失败")
+        return {"PDF绝对路径":os.path.abspath(pdf_path),"处理失败":f"{type(e).__name__}: {e}","文件损坏":isinstance(e,fitz.FileDataError)}
+
+def is_failed(pdf_result):
+    """
+    pdf_result是process_pdf_safely处理失败时的结果
+    """
+    return isinstance(pdf_result,dict) and "处理失败" in pdf_result
+
+def process_pdf_folder(input_folder,workers=1):
+    """
+    遍历输入文件夹中的所有PDF文件。按路径排序处理，这样每次运行输出的csv行顺序都一样，方便比较。
+    workers>1时用进程池并行处理，结果仍按路径顺序合并。
+    每处理完一个pdf就写入csv和进度文件，如果本次输出文件夹中已经有进度文件(--resume)，跳过已经处理完的pdf。
+    """
+    pdf_paths = sorted(os.path.join(input_folder, filename) for filename in os.listdir(input_folder) if filename.endswith(".pdf"))
+    done_keys = load_progress()  # --resume时，跳过上次已经处理完的pdf
+    if done_keys:
+        todo_paths = [pdf_path for pdf_path in pdf_paths if get_progress_key(pdf_path) not in done_keys]
+        logger.info(f"跳过{len(pdf_paths)-len(todo_paths)}个已经处理过的PDF文件")
+        pdf_paths = todo_paths
+    OCR.stage_timer = metrics.stage  # 统计渲染和ocr的耗时
+    get_invoice_index()  # 在启动子进程前创建发票索引，子进程只读
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if workers <= 1:
+            pdf_infos_to_csv(process_pdf_safely(pdf_path) for pdf_path in pdf_paths)  # 每处理完一个就写入csv
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers,initializer=init_worker,initargs=(get_worker_config(),)) as executor:
+                pdf_infos_to_csv(executor.map(process_pdf_safely,pdf_paths))  # map返回结果的顺序和pdf_paths一致
+    finally:  # 出错或Ctrl+C中断时也记录本次运行的结束时间和发票数
+        close_sqlite_sink()
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(this_time_output_folder,"profile.prof"))
+        stats_text = io.StringIO()
+        pstats.Stats(profiler,stream=stats_text).sort_stats("cumulative").print_stats(30)
+        logger.info(stats_text.getvalue())
+    write_metrics_summary()
+
+def watch_input_folder(path_queue,seen_keys,stop_event):
+    """
+    --watch: 每隔watch_interval秒扫描一次input_folder，把新出现的或者被修改过的pdf放进path_queue。
+    pdf要在连续两次扫描中大小和修改时间都没变才会处理，避免处理还没复制完的文件。
+    seen_keys是已经处理过(或已经放进队列)的pdf的key(见get_progress_key)，pdf被修改后key会变，会重新处理
+    """
+    last_keys = set()
+    while not stop_event.is_set():
+        keys = set()
+        for filename in sorted(os.listdir(input_folder)):
+            if not filename.endswith(".pdf"):
+                continue
+            try:
+                key = get_progress_key(os.path.join(input_folder,filename))
+            except OSError:  # 扫描时文件被移走了
+                continue
+            keys.add(key)
+            if key in last_keys and key not in seen_keys:
+                seen_keys.add(key)
+                path_queue.put((key[0],None))
+        last_keys = keys
+        stop_event.wait(watch_interval)
+
+def read_paths_from_stdin(path_queue):
+    """
+    --stdin: 每行一个pdf路径。stdin结束时放一个(None,None)
+    """
+    for line in sys.stdin:
+        pdf_path = line.strip()
+        if pdf_path != "":
+            path_queue.put((pdf_path,None))
+    path_queue.put((None,None))
+
+class PathRequestHandler(socketserver.StreamRequestHandler):
+    """
+    --listen: 客户端每发送一行pdf路径，处理完后返回一行json，内容和fa_piao_info.csv中的一行相同(表头:值)，处理失败时值都是空的
+    例：printf '/path/to/a.pdf\n' | nc 127.0.0.1 8765
+    """
+    def handle(self):
+        for line in self.rfile:
+            pdf_path = line.decode("utf8").strip()
+            if pdf_path == "":
+                continue
+            reply = queue.Queue()
+            self.server.path_queue.put((pdf_path,reply))
+            self.wfile.write((json.dumps(reply.get(),ensure_ascii=False)+"\n").encode("utf8"))
+
+def process_path_batch(items,executor=None):
+    """
+    处理一批(pdf路径,reply)，结果追加到当天的fa_piao_info_<日期>.csv和.jsonl中(每天一个文件)。
+    reply不为None时(来自--listen)，把这个pdf的结果放进reply。--split_pages时一个pdf有多张发票，放进去的是每张发票一个dict的列表
+    """
+    pdf_paths = [pdf_path for pdf_path, _ in items]
+    results = []
+    def pdf_infos():
+        pdf_info_iter = executor.map(process_pdf_safely,pdf_paths) if executor is not None else map(process_pdf_safely,pdf_paths)
+        for pdf_info in pdf_info_iter:
+            results.append(pdf_info)
+            yield pdf_info
+    date = datetime.now().strftime("%Y_%m_%d")
+    pdf_infos_to_csv(pdf_infos(),f"fa_piao_info_{date}.csv",f"fa_piao_info_{date}.jsonl")
+    for (pdf_path, reply), pdf_info in zip(items,results):
+        if reply is not None:
+            if is_failed(pdf_info):
+                reply.put(dict(zip(csv_field_name,[os.path.abspath(pdf_path)] + [""]*(len(csv_field_name)-1))))
+            elif isinstance(pdf_info,list):
+                reply.put([dict(zip(csv_field_name,pdf_info_to_row(res_dict))) for res_dict in pdf_info])
             else:
-                contract_number = ""
-            row_data.append(contract_number)
-            writer.writerow(row_data)
-
-
-def process_pdf_folder(input_folder):
-    # 遍历输入文件夹中的所有PDF文件
-    pdf_infos = []
-    for filename in os.listdir(input_folder):
-        if filename.endswith(".pdf"):
-            pdf_path = os.path.join(input_folder, filename)
-            print(f"===========正在处理PDF文件：{pdf_path}")  
-            pdf_texts = get_pdf_texts(pdf_path)
-            pdf_texts = pdf_texts[-1]  # 只取最后一页
-            if pdf_texts == "":
-                print(f"{pdf_path}是图片型pdf,请人工识别")
-                error_file.write(f"{pdf_path}是图片型pdf,请人工识别")
-            res_dict = {t:None for t in field_func_maps}  # 提取到的信息将放在res_dict中
-            res_dict["PDF绝对路径"] = os.path.abspath(pdf_path)
-            retry_time = 0
-            while not all(res_dict.values()) and retry_time < max_retry_time: # 如果有一个字段没有提取到，就重试，最多重试 max_retry_time 次
-                retry_time += 1
-                ocr_texts = OCR.ocr_pdf(pdf_path)[-1] # ocr, 同样只取最后一页
-                for field in res_dict:   # 对于每个信息
-                    if res_dict[field] is None:
-                        res_dict[field] = field_func_maps[field](ocr_texts,pdf_texts,pdf_path)  #使用这个信息的提取函数。field_func_maps里存了各个信息的提取函数。
-            pdf_infos.append(res_dict)
-    pdf_infos_to_csv(pdf_infos)
+                reply.put(dict(zip(csv_field_name,pdf_info_to_row(pdf_info))))
+    run_log.flush_logging()  # 长期运行时不等缓冲满，每批处理完就把日志写到文件
+
+def watch_pdf_folder(watch=True,read_stdin=False,listen_port=None,workers=1):
+    """
+    长期运行的模式：不断接收新的pdf并处理，ocr引擎只初始化一次，一直保持可用，每张发票几秒内就能得到结果。
+    pdf来源(可以同时使用)：
+    watch: 监视input_folder，新放进来的pdf会被处理(见watch_input_folder)
+    read_stdin: 从stdin读取pdf路径，stdin结束且没有其他来源时退出
+    listen_port: 在127.0.0.1的这个端口接收pdf路径，并返回结果(见PathRequestHandler)
+    各个来源把pdf放进同一个队列，这里每次把队列中已有的pdf作为一批处理。workers>1时用一个一直存在的进程池。
+    已经处理过的pdf记录在进度文件中，重启后不会重复处理。按Ctrl+C或发送SIGTERM退出。
+    """
+    path_queue = queue.Queue()
+    stop_event = threading.Event()
+    OCR.stage_timer = metrics.stage
+    get_invoice_index()
+    server = None
+    if watch:
+        threading.Thread(target=watch_input_folder,args=(path_queue,load_progress(),stop_event),daemon=True).start()
+        logger.info(f"监视文件夹：{os.path.abspath(input_folder)}")
+    if read_stdin:
+        threading.Thread(target=read_paths_from_stdin,args=(path_queue,),daemon=True).start()
+    if listen_port is not None:
+        server = socketserver.ThreadingTCPServer(("127.0.0.1",listen_port),PathRequestHandler)
+        server.daemon_threads = True
+        server.path_queue = path_queue
+        threading.Thread(target=server.serve_forever,daemon=True).start()
+        logger.info(f"监听：127.0.0.1:{listen_port}")
+    executor = None
+    if workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers,initializer=init_worker,initargs=(get_worker_config(),))
+    def stop_by_signal(signum,frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM,stop_by_signal)  # 用kill或systemd停止时也和Ctrl+C一样正常退出
+    try:
+        while True:
+            items = [path_queue.get()]
+            while True:  # 把队列中已有的都取出来，作为一批
+                try:
+                    items.append(path_queue.get_nowait())
+                except queue.Empty:
+                    break
+            stdin_closed = any(pdf_path is None for pdf_path, _ in items)
+            items = [item for item in items if item[0] is not None]
+            if items:
+                process_path_batch(items,executor)
+            if stdin_closed and not watch and listen_port is None:
+                break
+    except KeyboardInterrupt:
+        logger.info("收到Ctrl+C或SIGTERM，退出")
+    finally:
+        stop_event.set()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        if executor is not None:
+            executor.shutdown()
+        close_sqlite_sink()
+        write_metrics_summary()
+
+def write_metrics_summary():
+    """
+    汇总metrics.jsonl：各阶段总耗时、p50/p95/p99、最慢的发票，写到metrics_summary.json并打印
+    """
+    metrics_path = os.path.join(this_time_output_folder,metrics_file_name)
+    if not os.path.exists(metrics_path):
+        return
+    summary = metrics.summarize(metrics_path)
+    with open(os.path.join(this_time_output_folder,metrics_summary_file_name),"w",encoding="utf8") as file:
+        json.dump(summary,file,ensure_ascii=False,indent=2)
+    logger.info(metrics.format_summary(summary))
             
     
 
@@ -420,31 +1228,61 @@ def process_pdf_folder(input_folder):
 
 if __name__ == "__main__":
 
-    # 下面4行解析命令行参数，获取发票文件夹路径
+    # 下面几行解析命令行参数，获取发票文件夹路径和提取模式
     parser = argparse.ArgumentParser(description="Process PDF files to extract invoice information.")
     parser.add_argument("--input_folder", type=str, default=input_folder, help="Path to the input folder containing PDF files.")
+    parser.add_argument("--extract_mode", type=str, default=extract_mode, choices=["text_first","ocr"], help="text_first: try the PDF text layer first and OCR only missing fields; ocr: always OCR.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes. Each worker initializes its own OCR engine and logs to workers/ in the output folder.")
+    parser.add_argument("--resume", type=str, default=None, help="Output folder of an interrupted run. Invoices already recorded in its progress file are skipped and new rows are appended.")
+    parser.add_argument("--no_cache", "--no-cache", action="store_true", help="Do not read or write the result cache.")
+    parser.add_argument("--rebuild_cache", "--rebuild-cache", action="store_true", help="Ignore cached results, re-extract every invoice and refresh the cache.")
+    parser.add_argument("--ocr_backend", type=str, default=ocr_backend, choices=list(OCR.backends), help="OCR backend. 'stub' returns the PDF text layer instead of running OCR, for testing without WeChatOCR.")
+    parser.add_argument("--profile", action="store_true", help="Run under cProfile and write profile.prof (and workers/profile_<pid>.prof) to the output folder.")
+    parser.add_argument("--log_level", type=str, default=log_level, choices=["DEBUG","INFO","WARNING","ERROR"], help="Only log messages at or above this level.")
+    parser.add_argument("--log_background", action="store_true", help="Write log files from a background thread instead of buffering them in memory.")
+    parser.add_argument("--duplicates", type=str, default=duplicates_mode, choices=["flag","skip","off"], help="Invoices already seen under another file name (same 发票号码, seller tax ID and amount, across runs) are listed in duplicates.csv. flag: also keep them in the CSV; skip: leave them out of the CSV; off: no duplicate check.")
+    parser.add_argument("--output", type=str, nargs="+", default=output_formats, choices=["csv","sqlite"], help="Output sinks. csv: fa_piao_info.csv in the run folder; sqlite: all runs go to outputs/fa_piao.sqlite3, indexed by 发票号码, tax IDs and 合同编号.")
+    parser.add_argument("--split_pages", action="store_true", help="A PDF may hold several invoices: extract every page that looks like an invoice (one row per invoice, see the 页码 column) instead of only the last page.")
+    parser.add_argument("--watch", action="store_true", help="Keep running: watch input_folder and process new PDFs as they arrive. Output goes to outputs/watch, one CSV/JSONL per day.")
+    parser.add_argument("--watch_interval", type=float, default=watch_interval, help="Seconds between two scans of input_folder in --watch mode.")
+    parser.add_argument("--stdin", action="store_true", help="Keep running: read PDF paths from stdin, one per line.")
+    parser.add_argument("--listen", type=int, default=None, help="Keep running: accept PDF paths on 127.0.0.1:PORT, one per line, and reply with one JSON line per PDF.")
     args = parser.parse_args()
     input_folder = args.input_folder
+    extract_mode = args.extract_mode
+    use_cache = not args.no_cache
+    rebuild_cache = args.rebuild_cache
+    ocr_backend = args.ocr_backend
+    OCR.set_backend(ocr_backend)
+    profile = args.profile
+    log_level = args.log_level
+    log_background = args.log_background
+    watch_interval = args.watch_interval
+    duplicates_mode = args.duplicates
+    output_formats = args.output
+    split_pages = args.split_pages
+    daemon_mode = args.watch or args.stdin or args.listen is not None
 
     # 创建输出文件夹
     if not os.path.exists(output_folder):
         os.makedirs(output_folder,exist_ok=True)
     current_time = datetime.now()
     formatted_time = current_time.strftime("%Y_%m_%d_%H_%M_%S")
+    if args.resume is not None:
+        this_time_output_folder = args.resume  # 接着上次中断的运行继续
+    if this_time_output_folder is None and daemon_mode:
+        this_time_output_folder = os.path.join(output_folder,watch_output_folder_name)  # 长期运行时固定输出到一个文件夹，重启后接着写
     if this_time_output_folder is None:
         this_time_output_folder = os.path.join(output_folder,formatted_time)
     os.makedirs(this_time_output_folder,exist_ok=True)
+    log_mode = "a" if args.resume is not None or daemon_mode else "w"  # --resume和长期运行时日志接着写
 
-    # 设置同时向命令行和文件输出日志
-    all_log_file_name = os.path.join(this_time_output_folder,"all.log")
-    f= open(all_log_file_name,"w",encoding="utf8")
-    set_runing_log_output(f)  #同时输出到控制台和文件
-
-    # 创建警告和错误日志输出的文件
-    warning_file = open(os.path.join(this_time_output_folder,"warning.log"),"w",encoding="utf8")  #警告日志 输出位置
-    error_file = open(os.path.join(this_time_output_folder,"error.log"),"w",encoding="utf8")   # 无法识别的文件的输出日志
+    # 设置日志输出：命令行、all.log、warning.log、error.log、run.jsonl，提取失败的诊断信息写到diagnostics.jsonl.gz
+    run_log.setup_logging(this_time_output_folder,"",log_mode,log_level,log_background)
 
-    
-
-    # 遍历PDF文件夹，提取发票信息
-    process_pdf_folder(input_folder)
\ No newline at end of file
+    if daemon_mode:
+        # 长期运行，不断处理新的发票
+        watch_pdf_folder(args.watch,args.stdin,args.listen,args.workers)
+    else:
+        # 遍历PDF文件夹，提取发票信息
+        process_pdf_folder(input_folder,args.workers)
\ No newline at end of file
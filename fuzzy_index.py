@@ -0,0 +1,83 @@
+from collections import namedtuple
+from typing import List, Optional
+
+# 模糊匹配的结果：text是pdf中匹配到的文本，score是相似度(0~1)，distance是编辑距离
+FuzzyMatch = namedtuple("FuzzyMatch", ["text", "score", "distance"])
+
+
+def _grams(text:str, n:int):
+    """
+    text的所有字符n-gram(去重)。text比n短时，整个text作为一个gram
+    """
+    if len(text) < n:
+        return {text} if text else set()
+    return {text[i:i+n] for i in range(len(text) - n + 1)}
+
+def bounded_edit_distance(a:str, b:str, max_distance:int):
+    """
+    a和b的编辑距离，超过max_distance时提前结束并返回None
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return None
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i] + [0] * len(b)
+        for j, cb in enumerate(b, 1):
+            current[j] = min(previous[j] + 1, current[j-1] + 1, previous[j-1] + (ca != cb))
+        if min(current) > max_distance:  # 这一行最小值都超过了，最后的结果一定超过
+            return None
+        previous = current
+    return previous[-1] if previous[-1] <= max_distance else None
+
+
+class FuzzyIndex(object):
+    """
+    一页pdf文本的模糊匹配索引，每页只建一次，所有字段共用。
+    用字符n-gram倒排索引找出和查询文本有足够多相同n-gram的候选，再用有上限的编辑距离验证，
+    代替对每个token都跑一遍difflib.SequenceMatcher。
+    相似度 = 1 - 编辑距离/两者中较长的长度，低于cutoff的不算匹配。
+    """
+    def __init__(self, tokens:List[str], n:int=2):
+        self.n = n
+        self.tokens = []
+        self.gram_index = {}  # gram: [token下标,...]
+        seen = set()
+        for token in tokens:
+            if token == "" or token in seen:
+                continue
+            seen.add(token)
+            index = len(self.tokens)
+            self.tokens.append(token)
+            for gram in _grams(token, n):
+                self.gram_index.setdefault(gram, []).append(index)
+
+    def best_match(self, query:str, cutoff:float=0.8) -> Optional[FuzzyMatch]:
+        """
+        返回相似度最高且不低于cutoff的FuzzyMatch，没有时返回None
+        """
+        query_grams = _grams(query, self.n)
+        if not query_grams:
+            return None
+        # 每处编辑最多破坏n个gram，所以编辑距离不超过max_distance的候选至少有这么多相同的gram
+        max_query_distance = int((1 - cutoff) * len(query) / cutoff + 1e-9)  # 候选最长为len(query)/cutoff
+        min_shared = max(1, len(query_grams) - self.n * max_query_distance)
+        shared_counts = {}
+        for gram in query_grams:
+            for index in self.gram_index.get(gram, ()):
+                shared_counts[index] = shared_counts.get(index, 0) + 1
+        best = None
+        for index in sorted(shared_counts):  # 按页面顺序，相似度相同时取靠前的
+            if shared_counts[index] < min_shared:
+                continue
+            token = self.tokens[index]
+            longer = max(len(query), len(token))
+            max_distance = int((1 - cutoff) * longer + 1e-9)  # 加1e-9避免浮点误差，比如(1-0.8)*10=1.999...
+            distance = bounded_edit_distance(query, token, max_distance)
+            if distance is None:
+                continue
+            score = 1 - distance / longer
+            if score >= cutoff and (best is None or score > best.score):
+                best = FuzzyMatch(token, score, distance)
+        return best
@@ -0,0 +1,73 @@
+import os
+import json
+import sqlite3
+from datetime import datetime
+from collections import namedtuple
+
+# 索引中的一张发票：pdf_path是第一次出现时的pdf，fields是这张发票提取到的字段(res_dict中field_specs的那些字段)
+IndexEntry = namedtuple("IndexEntry", ["fa_piao_hao_ma", "xiao_shou_fang_shui_hao", "he_ji_jin_e", "pdf_path", "first_seen", "fields"])
+
+
+def format_amount(amount):
+    """
+    金额统一成两位小数的字符串，避免84621.28和84621.280这样的差异
+    """
+    return f"{float(amount):.2f}"
+
+
+class InvoiceIndex(object):
+    """
+    跨多次运行的发票索引，用来发现重复的发票(同一张发票换了文件名又提交了一次)。
+    存在sqlite数据库中，key是(发票号码,销售方纳税人识别号,价税合计金额)，同一个key第一次出现的pdf才是原发票，之后出现的都是重复。
+    只有主进程写入(写csv时)；子进程只读，用来在ocr之前根据文字层提取到的发票号码提前发现重复(见extract.find_duplicate_before_ocr)。
+    用WAL模式，读和写可以同时进行。
+    """
+    def __init__(self, db_path, readonly=False):
+        self.db_path = db_path
+        if readonly:
+            self.conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+            return
+        folder = os.path.dirname(db_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS invoice_index (
+            fa_piao_hao_ma TEXT NOT NULL,
+            xiao_shou_fang_shui_hao TEXT NOT NULL,
+            he_ji_jin_e TEXT NOT NULL,
+            pdf_path TEXT NOT NULL,
+            first_seen TEXT NOT NULL,
+            fields TEXT NOT NULL,
+            PRIMARY KEY (fa_piao_hao_ma, xiao_shou_fang_shui_hao, he_ji_jin_e))""")
+        self.conn.commit()
+
+    def lookup(self, fa_piao_hao_ma):
+        """
+        返回这个发票号码的所有IndexEntry(发票号码相同，销售方或金额可能不同)
+        """
+        rows = self.conn.execute("SELECT fa_piao_hao_ma, xiao_shou_fang_shui_hao, he_ji_jin_e, pdf_path, first_seen, fields FROM invoice_index WHERE fa_piao_hao_ma = ?", (fa_piao_hao_ma,)).fetchall()
+        return [IndexEntry(*row[:5], json.loads(row[5])) for row in rows]
+
+    def find_duplicate(self, fa_piao_hao_ma, xiao_shou_fang_shui_hao, he_ji_jin_e, pdf_path):
+        """
+        key完全相同、但pdf不是同一个文件时，返回原发票的IndexEntry；否则返回None。
+        同一个pdf重新运行不算重复
+        """
+        for entry in self.lookup(fa_piao_hao_ma):
+            if entry.xiao_shou_fang_shui_hao == xiao_shou_fang_shui_hao and entry.he_ji_jin_e == format_amount(he_ji_jin_e) and entry.pdf_path != pdf_path:
+                return entry
+        return None
+
+    def add(self, fa_piao_hao_ma, xiao_shou_fang_shui_hao, he_ji_jin_e, pdf_path, fields):
+        """
+        记录一张发票。key已经存在时不覆盖(保留第一次出现的pdf)
+        """
+        self.conn.execute("INSERT OR IGNORE INTO invoice_index VALUES (?, ?, ?, ?, ?, ?)",
+                          (fa_piao_hao_ma, xiao_shou_fang_shui_hao, format_amount(he_ji_jin_e), pdf_path,
+                           datetime.now().isoformat(timespec="seconds"), json.dumps(fields, ensure_ascii=False)))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
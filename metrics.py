@@ -0,0 +1,124 @@
+import json
+import time
+from contextlib import contextmanager
+
+"""
+每张发票各个阶段的耗时统计。
+process_pdf开始处理一张发票时调用begin，结束时调用end得到这张发票的统计结果；
+中间各个阶段用 with stage("阶段名"): 包起来，同一阶段多次执行时耗时会累加，次数也会记录。
+不在begin和end之间时(比如benchmark单独调用提取函数)stage什么都不做。
+"""
+
+_current = None
+
+
+class InvoiceMetrics(object):
+    def __init__(self, pdf_path):
+        self.pdf_path = pdf_path
+        self.start = time.perf_counter()
+        self.stages = {}  # 阶段名:[总耗时秒,次数]
+        self.counters = {}  # 计数，比如ocr重试次数
+
+    def add(self, name, seconds):
+        item = self.stages.setdefault(name, [0.0, 0])
+        item[0] += seconds
+        item[1] += 1
+
+    def to_dict(self):
+        return {
+            "path":self.pdf_path,
+            "total":time.perf_counter() - self.start,
+            "stages":{name:{"seconds":seconds, "calls":calls} for name, (seconds, calls) in self.stages.items()},
+            "counters":self.counters,
+        }
+
+def begin(pdf_path):
+    global _current
+    _current = InvoiceMetrics(pdf_path)
+    return _current
+
+def end():
+    """
+    结束当前发票的统计，返回统计结果(dict，可以直接写成json)
+    """
+    global _current
+    if _current is None:
+        return None
+    result = _current.to_dict()
+    _current = None
+    return result
+
+@contextmanager
+def stage(name):
+    if _current is None:
+        yield
+        return
+    metrics = _current
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add(name, time.perf_counter() - start)
+
+def count(name, n=1):
+    if _current is not None:
+        _current.counters[name] = _current.counters.get(name, 0) + n
+
+def percentiles(values, ps=(50, 95, 99)):
+    """
+    返回{p:值}，用最近秩法
+    """
+    values = sorted(values)
+    if not values:
+        return {p:0.0 for p in ps}
+    return {p:values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))] for p in ps}
+
+def summarize(metrics_path, slowest=10):
+    """
+    读取metrics.jsonl(每行是一张发票的end()结果)，返回汇总：
+    每个阶段的总耗时、调用次数、每张发票耗时的p50/p95/p99，每张发票总耗时的分位数，计数的总和，以及最慢的slowest张发票
+    """
+    totals = []
+    stage_values = {}
+    stage_calls = {}
+    counters = {}
+    with open(metrics_path, "r", encoding="utf8") as file:
+        for line in file:
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:  # 运行中断时最后一行可能不完整
+                continue
+            totals.append((item["total"], item["path"]))
+            for name, value in item["stages"].items():
+                stage_values.setdefault(name, []).append(value["seconds"])
+                stage_calls[name] = stage_calls.get(name, 0) + value["calls"]
+            for name, n in item["counters"].items():
+                counters[name] = counters.get(name, 0) + n
+    stages = {}
+    for name, values in stage_values.items():
+        p = percentiles(values)
+        stages[name] = {"total":sum(values), "calls":stage_calls[name], "invoices":len(values), "p50":p[50], "p95":p[95], "p99":p[99]}
+    p = percentiles([t for t, _ in totals])
+    return {
+        "invoices":len(totals),
+        "total":sum(t for t, _ in totals),
+        "p50":p[50], "p95":p[95], "p99":p[99],
+        "stages":stages,
+        "counters":counters,
+        "slowest":[{"path":path, "total":t} for t, path in sorted(totals, reverse=True)[:slowest]],
+    }
+
+def format_summary(summary):
+    """
+    把summarize的结果转成方便阅读的文本
+    """
+    lines = [f"发票数:{summary['invoices']}  总耗时:{summary['total']:.2f}s  每张p50/p95/p99(ms): {summary['p50']*1000:.1f}/{summary['p95']*1000:.1f}/{summary['p99']*1000:.1f}"]
+    lines.append(f"{'阶段':<32}{'总耗时(s)':>10}{'次数':>8}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}")
+    for name, s in sorted(summary["stages"].items(), key=lambda item: -item[1]["total"]):
+        lines.append(f"{name:<32}{s['total']:>10.2f}{s['calls']:>8}{s['p50']*1000:>10.2f}{s['p95']*1000:>10.2f}{s['p99']*1000:>10.2f}")
+    if summary["counters"]:
+        lines.append("计数: " + "  ".join(f"{name}:{n}" for name, n in summary["counters"].items()))
+    lines.append("最慢的发票:")
+    for item in summary["slowest"]:
+        lines.append(f"  {item['total']*1000:.1f}ms  {item['path']}")
+    return "\n".join(lines)
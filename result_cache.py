@@ -0,0 +1,98 @@
+import os
+import json
+import hashlib
+
+
+class ResultCache(object):
+    """
+    按pdf内容缓存提取结果，跨多次运行有效。
+    key = sha256(pdf文件的字节 + 提取程序版本号 + 影响结果的选项(ocr后端、提取模式等))，
+    pdf内容没变、提取程序和选项也没变时，直接用缓存的结果，不需要解析pdf和ocr。
+    每个结果存成cache_folder/key前两位/key.json，内容是{"res_dict":..., "ocr_texts":...}
+    缓存总大小超过max_bytes时，删除最久没有用过的结果(按文件修改时间，命中时会更新修改时间)。
+    多个进程可以同时使用同一个缓存文件夹：写入时先写临时文件再改名，不会读到写了一半的文件。
+    """
+    def __init__(self, cache_folder, extractor_version, max_bytes=512*1024*1024, rebuild=False):
+        self.cache_folder = cache_folder
+        self.extractor_version = extractor_version
+        self.max_bytes = max_bytes
+        self.rebuild = rebuild  # 为True时不读旧的缓存，只写入新的结果
+        os.makedirs(self.cache_folder, exist_ok=True)
+        self.total_bytes = sum(size for _, _, size in self._entries())
+
+    def _entries(self):
+        """
+        返回[(修改时间,路径,大小),...]
+        """
+        entries = []
+        for sub_folder in os.listdir(self.cache_folder):
+            sub_folder = os.path.join(self.cache_folder, sub_folder)
+            if not os.path.isdir(sub_folder):
+                continue
+            for filename in os.listdir(sub_folder):
+                if not filename.endswith(".json"):
+                    continue
+                path = os.path.join(sub_folder, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:  # 被别的进程删掉了
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+        return entries
+
+    def make_key(self, pdf_bytes:bytes, *options):
+        """
+        options是会影响提取结果的选项，比如stub后端的结果不能给微信ocr用
+        """
+        h = hashlib.sha256(pdf_bytes)
+        h.update(self.extractor_version.encode("utf8"))
+        for option in options:
+            h.update(b"\0" + str(option).encode("utf8"))
+        return h.hexdigest()
+
+    def _path(self, key:str):
+        return os.path.join(self.cache_folder, key[:2], key + ".json")
+
+    def get(self, key:str):
+        """
+        返回缓存的{"res_dict":..., "ocr_texts":...}，没有缓存时返回None
+        """
+        if self.rebuild:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf8") as file:
+                entry = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        try:
+            os.utime(path)  # 更新修改时间，表示最近用过
+        except FileNotFoundError:
+            pass
+        return entry
+
+    def put(self, key:str, res_dict:dict, ocr_texts=None):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf8") as file:
+            json.dump({"res_dict":res_dict, "ocr_texts":ocr_texts}, file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        self.total_bytes += os.path.getsize(path)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        删除最久没有用过的结果，直到总大小降到max_bytes的90%以下
+        """
+        entries = sorted(self._entries())
+        self.total_bytes = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= size
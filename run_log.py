@@ -0,0 +1,172 @@
+import os
+import sys
+import gzip
+import json
+import queue
+import atexit
+import logging
+import logging.handlers
+from datetime import datetime
+
+"""
+运行日志。
+logger输出到：命令行、all.log(所有日志)、warning.log(只有WARNING)、error.log(ERROR及以上)、run.jsonl(所有日志，每行一个json)。
+写文件是缓冲的：日志先放在内存中，攒够buffer_capacity条或程序结束时才写到文件，不会每条日志都flush一次；
+background=True时改为由后台线程写文件，处理发票的线程只把日志放进队列。
+提取失败时不再把ocr文本、pdf文本和所有block打印到日志中，而是用note记录失败原因，
+一张发票处理完后(end_invoice)，如果有失败，把这张发票的完整信息只写一次到压缩的diagnostics.jsonl.gz中。
+"""
+
+logger = logging.getLogger("fa_piao")
+buffer_capacity = 1000  # 缓冲多少条日志后写一次文件
+
+_listener = None
+_file_handlers = []
+_diagnostics_file = None
+_notes = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    每条日志输出成一行json，logger.info(msg, extra={"fields":{...}})中的fields会合并到json中
+    """
+    def format(self, record):
+        item = {
+            "time":datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level":record.levelname,
+            "pid":record.process,
+            "msg":record.getMessage(),
+        }
+        item.update(getattr(record, "fields", {}))
+        return json.dumps(item, ensure_ascii=False, default=str)
+
+
+class LevelFilter(logging.Filter):
+    """
+    只保留某一个级别的日志，用于warning.log
+    """
+    def __init__(self, level):
+        super().__init__()
+        self.level = level
+
+    def filter(self, record):
+        return record.levelno == self.level
+
+
+def setup_logging(output_folder, suffix="", mode="w", level="INFO", background=False, console=True):
+    """
+    设置日志输出。日志文件放在output_folder中，文件名是 all{suffix}.log 等(多进程时suffix是进程号)。
+    mode: "w"新建，"a"追加(--resume)
+    level: 日志级别，低于这个级别的日志不输出
+    background: True时由后台线程写文件
+    可以重复调用(比如fork出来的子进程)，会先关闭之前的输出。
+    """
+    global _listener, _diagnostics_file
+    shutdown_logging()
+    logger.setLevel(level)
+    logger.propagate = False
+    text_formatter = logging.Formatter("%(message)s")
+    file_handlers = []
+    def file_handler(filename, formatter, level=None, only_level=None):
+        handler = logging.FileHandler(os.path.join(output_folder, filename), mode=mode, encoding="utf8")
+        handler.setFormatter(formatter)
+        if level is not None:
+            handler.setLevel(level)
+        if only_level is not None:
+            handler.addFilter(LevelFilter(only_level))
+        file_handlers.append(handler)
+    file_handler(f"all{suffix}.log", text_formatter)
+    file_handler(f"warning{suffix}.log", text_formatter, only_level=logging.WARNING)
+    file_handler(f"error{suffix}.log", text_formatter, level=logging.ERROR)
+    file_handler(f"run{suffix}.jsonl", JsonFormatter())
+    _file_handlers.extend(file_handlers)
+
+    if background:
+        log_queue = queue.Queue(-1)
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        _listener = logging.handlers.QueueListener(log_queue, *file_handlers, respect_handler_level=True)
+        _listener.start()
+    else:
+        for handler in file_handlers:
+            # MemoryHandler攒够buffer_capacity条才写到文件；flushLevel设成CRITICAL以上，ERROR也不会触发立即写
+            memory_handler = logging.handlers.MemoryHandler(buffer_capacity, flushLevel=logging.CRITICAL + 1, target=handler)
+            # MemoryHandler写到target时不再检查级别，所以级别和过滤器要设在MemoryHandler上
+            memory_handler.setLevel(handler.level)
+            for log_filter in handler.filters:
+                memory_handler.addFilter(log_filter)
+            logger.addHandler(memory_handler)
+    if console:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(text_formatter)
+        logger.addHandler(console_handler)
+    _diagnostics_file = gzip.open(os.path.join(output_folder, f"diagnostics{suffix}.jsonl.gz"), mode + "t", encoding="utf8")
+
+def shutdown_logging():
+    """
+    把缓冲中的日志写到文件，关闭所有输出。程序结束时会自动调用
+    """
+    global _listener, _diagnostics_file
+    if _listener is not None:
+        _listener.stop()  # 会先把队列中剩下的日志写完
+        _listener = None
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.flush()
+        handler.close()
+    for handler in _file_handlers:
+        handler.close()
+    _file_handlers.clear()
+    if _diagnostics_file is not None:
+        _diagnostics_file.close()
+        _diagnostics_file = None
+
+atexit.register(shutdown_logging)
+
+def flush_logging():
+    """
+    把缓冲中的日志马上写到文件，用于长期运行的模式(--watch)，不用等缓冲满或程序结束
+    """
+    for handler in logger.handlers:
+        handler.flush()
+    if _diagnostics_file is not None:
+        _diagnostics_file.flush()
+
+def discard_inherited_logging():
+    """
+    fork出来的子进程会继承主进程的日志输出和还没写出去的缓冲。
+    子进程中不能flush或close它们(会把主进程的日志重复写一遍，或者破坏主进程的diagnostics.jsonl.gz)，只能丢掉
+    """
+    global _listener, _diagnostics_file
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        if isinstance(handler, logging.handlers.MemoryHandler):
+            handler.buffer = []
+    _file_handlers.clear()
+    _listener = None
+    _diagnostics_file = None
+
+def begin_invoice():
+    """
+    开始处理一张发票，之后的note都记在这张发票上
+    """
+    global _notes
+    _notes = []
+
+def note(pdf_path, func_name, info, **fields):
+    """
+    记录一次提取失败：输出一条简短的WARNING日志，并记在当前发票上，发票处理完后统一写诊断信息
+    """
+    logger.warning(f"{func_name}_error:{pdf_path} {info}", extra={"fields":{"event":"extract_error", "path":pdf_path, "func":func_name, "info":str(info), **fields}})
+    if _notes is not None:
+        _notes.append({"func":func_name, "info":str(info), **fields})
+
+def end_invoice(pdf_path, **dump):
+    """
+    当前发票处理完。如果处理过程中有note，把失败原因和dump(pdf文本、blocks、ocr文本等)作为一行写到diagnostics.jsonl.gz中。
+    返回这张发票的note列表
+    """
+    global _notes
+    notes, _notes = _notes or [], None
+    if notes and _diagnostics_file is not None:
+        _diagnostics_file.write(json.dumps({"path":pdf_path, "notes":notes, **dump}, ensure_ascii=False, default=str) + "\n")
+    return notes
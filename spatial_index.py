@@ -0,0 +1,66 @@
+from bisect import bisect_left, bisect_right
+from typing import List, Optional
+
+
+class SpatialIndex(object):
+    """
+    一页blocks的空间索引，每页只建一次(blocks变了才重建)，所有字段共用。
+    blocks是PdfLayout.blocks：[(text,x0,y0,x1,y1),...]，compact_texts是去掉空白后的文本，与blocks一一对应。
+    按y0排好序的数组(y0s)用二分查找，只检查y范围可能重合的blocks，代替每次查询都遍历所有blocks：
+    row_band: 和一行(比如价税合计这一行)的y范围有重合的blocks
+    rect: 完全在一个矩形区域内的blocks(比如备注区域)
+    locate: 包含某个文本的block(比如名称税号的4个值)，在所有文本连成的字符串中查找，不用每个block都find一次
+    row_band和rect返回block下标的列表，按原来blocks的顺序
+    """
+    def __init__(self, blocks:List[tuple], compact_texts:List[str]):
+        self.blocks = blocks
+        self.order = sorted(range(len(blocks)), key=lambda i: blocks[i][2])  # 按y0排序的block下标
+        self.y0s = [blocks[i][2] for i in self.order]
+        self.max_height = max((b[4] - b[2] for b in blocks), default=0)  # 和y0一起确定可能和某个y范围重合的blocks
+        # 所有block的文本用"\n"连起来，locate时在整个字符串中查找(C实现)，再二分查找位置属于哪个block
+        self.joined_text = "\n".join(compact_texts)
+        self.starts = []
+        start = 0
+        for text in compact_texts:
+            self.starts.append(start)
+            start += len(text) + 1
+
+    def _y_candidates(self, y0, y1):
+        """
+        可能和(y0,y1)有重合的blocks：block的y0在(y0-max_height, y1]之间
+        """
+        return self.order[bisect_left(self.y0s, y0 - self.max_height):bisect_right(self.y0s, y1)]
+
+    def row_band(self, y0, y1) -> List[int]:
+        """
+        y范围和(y0,y1)有重合的blocks：上边或下边在(y0,y1)之内，或者整个包住(y0,y1)。
+        上下边都和(y0,y1)相同的block(比如这一行的锚点本身)不算
+        """
+        res = []
+        for i in self._y_candidates(y0, y1):
+            _, _, by0, _, by1 = self.blocks[i]
+            if (y0 < by0 < y1) or (y0 < by1 < y1) or (by0 < y0 and by1 > y1):
+                res.append(i)
+        return sorted(res)
+
+    def rect(self, x0=float("-inf"), y0=float("-inf"), x1=float("inf"), y1=float("inf")) -> List[int]:
+        """
+        完全在矩形(x0,y0,x1,y1)之内(不含边界)的blocks，不限制的边用默认的无穷大
+        """
+        res = []
+        for i in self.order[bisect_right(self.y0s, y0):bisect_left(self.y0s, y1)]:
+            _, bx0, by0, bx1, by1 = self.blocks[i]
+            if by1 < y1 and bx0 > x0 and bx1 < x1:
+                res.append(i)
+        return sorted(res)
+
+    def locate(self, text:str) -> Optional[int]:
+        """
+        最后一个包含text(不含空白)的block的下标，找不到时返回None
+        """
+        if text == "" or any(c.isspace() for c in text):  # compact_texts中没有空白，不会包含text
+            return None
+        pos = self.joined_text.rfind(text)
+        if pos == -1:
+            return None
+        return bisect_right(self.starts, pos) - 1
@@ -0,0 +1,123 @@
+import os
+import json
+import sqlite3
+from datetime import datetime
+
+"""
+把提取结果写到sqlite数据库中，所有运行的结果都在一个数据库里，可以按发票号码、税号、合同编号直接查询，不用在很多csv中查找。
+例：sqlite3 outputs/fa_piao.sqlite3 "SELECT * FROM invoices WHERE fa_piao_hao_ma = '...'"
+invoices表的列和fa_piao_info.csv一一对应，另外有：
+每个(pdf_path,ye_ma)只有一行，是最后一次提取的结果，重复写入(比如--resume重新处理了一个pdf)时替换旧的行。
+run_id: 最后是哪一次运行提取的，见runs表(开始结束时间、输入文件夹、提取模式、ocr后端、提取程序版本、发票数)
+ye_ma: 发票在pdf中的第几页(从1开始)，--split_pages时一个pdf可以有多行
+ocr_cheng_gong_ci_shu: 第几次ocr后提取到所有字段，0表示没有用ocr
+duplicate_of: 重复的发票时，原发票的pdf(见invoice_index.py)
+confidence: 每个字段的置信度(0~1)，json，见extract.extract_pdf_info
+"""
+
+invoice_columns = [
+    ("pdf_path", "TEXT"),
+    ("fa_piao_lei_xing", "TEXT"),
+    ("fa_piao_hao_ma", "TEXT"),
+    ("fa_piao_hao_ma_jian_xie", "TEXT"),
+    ("gou_mai_fang_ming_cheng", "TEXT"),
+    ("gou_mai_fang_shui_hao", "TEXT"),
+    ("xiao_shou_fang_ming_cheng", "TEXT"),
+    ("xiao_shou_fang_shui_hao", "TEXT"),
+    ("he_ji_jin_e", "REAL"),
+    ("bei_zhu", "TEXT"),
+    ("he_tong_bian_hao", "TEXT"),
+    ("ye_ma", "INTEGER"),
+    ("ocr_cheng_gong_ci_shu", "INTEGER"),
+    ("duplicate_of", "TEXT"),
+    ("confidence", "TEXT"),
+]
+indexed_columns = ["fa_piao_hao_ma", "gou_mai_fang_shui_hao", "xiao_shou_fang_shui_hao", "he_tong_bian_hao"]
+
+
+class SqliteSink(object):
+    """
+    批量写入：add只把一行放在内存中，攒够batch_size行时才在一个事务中用executemany写入，
+    比每行一个事务快很多。flush写入剩下的行。
+    after_written登记的回调(比如记录进度)在它之前add的行提交之后才调用，进程被杀掉时不会出现进度记录了、数据库中却没有的行。
+    """
+    def __init__(self, db_path, batch_size=500):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.pending = []
+        self.callbacks = []  # 等pending中的行提交后再调用
+        self.run_id = None
+        self.invoice_count = 0
+        folder = os.path.dirname(db_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS runs (
+            run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            started_at TEXT, finished_at TEXT, output_folder TEXT, input_folder TEXT,
+            extract_mode TEXT, ocr_backend TEXT, extractor_version TEXT, invoice_count INTEGER)""")
+        columns = ", ".join(f"{name} {column_type}" for name, column_type in invoice_columns)
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS invoices (id INTEGER PRIMARY KEY AUTOINCREMENT, run_id INTEGER REFERENCES runs(run_id), {columns}, UNIQUE(pdf_path, ye_ma))")
+        for name in indexed_columns:
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS idx_invoices_{name} ON invoices({name})")
+        self.conn.commit()
+
+    def begin_run(self, **run_info):
+        """
+        在runs表中记录本次运行，run_info是runs表中的列(output_folder、input_folder等)
+        """
+        run_info["started_at"] = datetime.now().isoformat(timespec="seconds")
+        names = list(run_info)
+        cursor = self.conn.execute(f"INSERT INTO runs ({', '.join(names)}) VALUES ({', '.join('?' for _ in names)})", [run_info[name] for name in names])
+        self.conn.commit()
+        self.run_id = cursor.lastrowid
+
+    def add(self, record, duplicate_of=None, confidence=None):
+        """
+        record是extract.InvoiceRecord。攒够batch_size行时写入数据库并返回True，否则返回False
+        """
+        values = [getattr(record, name) for name, _ in invoice_columns[:-2]]  # InvoiceRecord中提取不到的字段已经是None
+        values.append(duplicate_of)
+        values.append(json.dumps(confidence, ensure_ascii=False) if confidence is not None else None)
+        self.pending.append([self.run_id] + values)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+            return True
+        return False
+
+    def after_written(self, callback):
+        """
+        已经add的行都提交后调用callback()：没有等待写入的行时马上调用，否则在下一次flush提交后调用
+        """
+        if self.pending:
+            self.callbacks.append(callback)
+        else:
+            callback()
+
+    def flush(self):
+        """
+        在一个事务中写入所有还没写入的行，提交后调用after_written登记的回调
+        """
+        if not self.pending:
+            return
+        names = ["run_id"] + [name for name, _ in invoice_columns]
+        with self.conn:  # 一个事务，出错时回滚。同一个pdf的同一页已经有一行时(--resume重新处理、再次运行)替换成新的结果
+            self.conn.executemany(f"INSERT OR REPLACE INTO invoices ({', '.join(names)}) VALUES ({', '.join('?' for _ in names)})", self.pending)
+        self.invoice_count += len(self.pending)
+        self.pending = []
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def close(self):
+        """
+        写入剩下的行，记录本次运行的结束时间和发票数
+        """
+        self.flush()
+        if self.run_id is not None:
+            self.conn.execute("UPDATE runs SET finished_at = ?, invoice_count = ? WHERE run_id = ?",
+                              (datetime.now().isoformat(timespec="seconds"), self.invoice_count, self.run_id))
+            self.conn.commit()
+        self.conn.close()